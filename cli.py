@@ -0,0 +1,191 @@
+""" Command-line interface for Stalmic Equipment Record Keeper.
+
+Runs the importers and the customer note push without a Tk window so that
+they can be scheduled. Exits with a non-zero status if the job fails.
+
+    python cli.py import-sales sales.csv
+    python cli.py push-notes
+"""
+
+import argparse
+import signal
+import sys
+import time
+import notify
+import reports
+from progress import CancelToken, Cancelled
+
+# Set by the first Ctrl-C so the job stops cleanly at the next batch.
+cancel = CancelToken()
+
+
+def import_sales(args):
+    """ Imports one or more sales CSVs."""
+    import dbfunctions as db
+    return run_files(lambda x, **kwargs: db.import_sales_csv(
+        x, use_ledger=not args.no_ledger,
+        skip_duplicates=args.skip_duplicates, **kwargs), args.files)
+
+
+def import_purchases(args):
+    """ Imports one or more purchase CSVs."""
+    import dbfunctions as db
+    return run_files(db.import_purchases_csv, args.files)
+
+
+def import_warranty(args):
+    """ Imports one or more warranty CSVs."""
+    import dbfunctions as db
+    return run_files(db.import_warranty_csv, args.files)
+
+
+def push_notes(args):
+    """ Pushes the equipment records to the customer notes."""
+    import dbfunctions as db
+    print("Pushing equipment to customer notes...")
+    start = time.perf_counter()
+    count = db.write_to_notes(progress=print_progress, cancel=cancel)
+    end_progress()
+    print_stats(count, "notes", time.perf_counter() - start)
+
+
+def write_report(args):
+    """ Writes an aggregate report as CSV."""
+    if args.output:
+        with open(args.output, 'w', newline='', encoding='utf-8') as file:
+            reports.write_csv(args.name, file)
+    else:
+        reports.write_csv(args.name, sys.stdout)
+
+
+def write_duplicates(args):
+    """ Writes the serial numbers on more than one record as CSV."""
+    if args.output:
+        with open(args.output, 'w', newline='', encoding='utf-8') as file:
+            reports.write_duplicates_csv(file)
+    else:
+        reports.write_duplicates_csv(sys.stdout)
+
+
+def create_indexes(args):
+    """ Creates the indexes the equipment searches rely on."""
+    import dbfunctions as db
+    created = db.create_indexes()
+    for name in created:
+        print("Created", name)
+    if not created:
+        print("All indexes already exist.")
+
+
+def run_files(importer, files):
+    """ Runs an importer over each file, printing statistics as it goes."""
+    total = 0
+    start = time.perf_counter()
+    for filename in files:
+        print("Importing {}...".format(filename))
+        file_start = time.perf_counter()
+        count = importer(filename, progress=print_progress, cancel=cancel)
+        end_progress()
+        print_stats(count, "records", time.perf_counter() - file_start)
+        total += count
+    if len(files) > 1:
+        print("Total:", end=' ')
+        print_stats(total, "records", time.perf_counter() - start)
+
+
+def print_progress(done, total, rate, eta):
+    """ Progress callback that keeps a status line on standard error."""
+    line = "  {}/{} rows, {:.1f} rows/s".format(done, total, rate)
+    if eta is not None:
+        line += ", {:.0f}s left".format(eta)
+    if sys.stderr.isatty():
+        sys.stderr.write("\r" + line.ljust(60))
+    else:
+        sys.stderr.write(line + "\n")
+    sys.stderr.flush()
+
+
+def end_progress():
+    if sys.stderr.isatty():
+        sys.stderr.write("\n")
+
+
+def interrupt(signum, frame):
+    """ Asks the job to stop at the next batch; a second Ctrl-C stops it
+    right away."""
+    if cancel.cancelled:
+        raise KeyboardInterrupt
+    sys.stderr.write("\nStopping after this batch (Ctrl-C again to abort "
+                     "now)...\n")
+    cancel.cancel()
+
+
+def print_stats(count, unit, elapsed):
+    """ Prints a throughput summary."""
+    rate = count / elapsed if elapsed > 0 else 0
+    print("{} {} in {:.2f}s ({:.1f} {}/s)".format(count, unit, elapsed,
+                                                  rate, unit))
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description="Headless jobs for the equipment record keeper.")
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+    for name, function, help in (
+            ('import-sales', import_sales, "import a sales CSV export"),
+            ('import-purchases', import_purchases,
+             "import a purchases CSV export"),
+            ('import-warranty', import_warranty,
+             "import a warranty CSV export")):
+        subparser = subparsers.add_parser(name, help=help)
+        subparser.add_argument('files', nargs='+', metavar='FILE')
+        subparser.set_defaults(function=function)
+        if name == 'import-sales':
+            subparser.add_argument(
+                '--no-ledger', action='store_true',
+                help="import every line, even ones imported before")
+            subparser.add_argument(
+                '--skip-duplicates', action='store_true',
+                help="skip serial numbers that are already in the database, "
+                "unless the export credits them")
+    subparser = subparsers.add_parser(
+        'push-notes', help="push the equipment records to customer notes")
+    subparser.set_defaults(function=push_notes)
+    subparser = subparsers.add_parser(
+        'report', help="write an aggregate report as CSV")
+    subparser.add_argument('name', choices=reports.REPORTS)
+    subparser.add_argument('-o', '--output', metavar='FILE',
+                           help="file to write (default: standard output)")
+    subparser.set_defaults(function=write_report)
+    subparser = subparsers.add_parser(
+        'duplicates', help="list serial numbers on more than one record")
+    subparser.add_argument('-o', '--output', metavar='FILE',
+                           help="file to write (default: standard output)")
+    subparser.set_defaults(function=write_duplicates)
+    subparser = subparsers.add_parser(
+        'create-indexes', help="create the indexes used by searches")
+    subparser.set_defaults(function=create_indexes)
+    return parser
+
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+    notify.set_headless()
+    signal.signal(signal.SIGINT, interrupt)
+    try:
+        args.function(args)
+    except Cancelled:
+        sys.stderr.write("Cancelled.\n")
+        return 130
+    except KeyboardInterrupt:
+        sys.stderr.write("Interrupted.\n")
+        return 130
+    except Exception as err:
+        sys.stderr.write("ERROR: {}: {}\n".format(type(err).__name__, err))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
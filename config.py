@@ -1,6 +1,7 @@
 import sys
 from os import path, getcwd
 import re
+from notify import show_error
 
 
 def get_config():
@@ -22,11 +23,13 @@ def get_config():
         error = "There was no configuration file found in the root folder."
         error += " Please make sure a config file is included that includes"
         error += " the server, database, username, and password."
-        tk.messagebox.showerror("Pick Ups To Notes", error)
+        show_error(error)
+        raise
     except AttributeError:
         error = "There was a problem with the configuration file."
         error += " Please make sure it includes a server, database, username, and password."
-        tk.messagebox.showerror("Pick Ups To Notes", error)
+        show_error(error)
+        raise
     return [server, database, username, password]
 
 config = get_config()
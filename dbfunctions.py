@@ -1,31 +1,136 @@
 """ Database functions module for Stalmic Equipment Record Keeper."""
 
 from contextlib import contextmanager
-from tkinter import messagebox
-import tkinter as tk
+import collections
+import functools
+import hashlib
+import itertools
+import queue
 import sys
 import csv
-import re
+import threading
+import time
 import dateutil.parser
 import dateutil.relativedelta
 import datetime
 import pyodbc
 from config import get_config
-from gui import TITLE
+from notify import show_error, show_info
+from searchindex import (EquipmentSearchIndex, SerialIndex, like_to_regex,
+                         is_supported, fold, normalize_serial)
+from resultcache import ResultCache
+import profiling
+from progress import BATCH_SIZE, Progress, in_batches
+from staging import SalesExport
+
+# SQL Server allows 2100 parameters per statement; leave some room for the
+# other filters.
+MAX_PARAMETERS = 2000
+
+
+# SQLSTATEs worth trying again: lost or failed connections, timeouts and
+# deadlocks.
+TRANSIENT_STATES = ('08S01', '08001', '08004', '08007', 'HYT00', 'HYT01',
+                    '40001')
+# Retries happen at one level only, around a whole unit of work, so
+# connect() itself doesn't retry. Waits are 0.5, 1, 2 and 4 seconds.
+RETRIES = 4
+# Seconds to wait before the first retry; doubled for each one after.
+BACKOFF = 0.5
+# True while retry() has attempts left, so that connection errors aren't
+# shown to the user for attempts that are about to be retried.
+_quiet = False
+
+
+class CircuitOpenError(Exception):
+    """ Raised instead of trying the server after repeated failures."""
+
+
+class CircuitBreaker:
+    """ Fails fast after threshold transient failures in a row, instead of
+    waiting through retries for a server that is down. After reset_timeout
+    seconds one attempt is let through to see if it is back. Failures and
+    successes are recorded where connections are opened and used, so every
+    path to the server counts."""
+    def __init__(self, threshold=8, reset_timeout=30):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened = None
+
+    def check(self):
+        if (self.opened is not None and
+                time.monotonic() - self.opened < self.reset_timeout):
+            raise CircuitOpenError(
+                "The database has failed {} times in a row; not trying again "
+                "for {} seconds.".format(self.failures, self.reset_timeout))
+
+    def success(self):
+        self.failures = 0
+        self.opened = None
+
+    def failure(self):
+        self.failures += 1
+        if self.failures >= self.threshold:
+            self.opened = time.monotonic()
+
+
+breaker = CircuitBreaker()
+
+
+def is_transient(err):
+    """ Whether an ODBC error is worth retrying."""
+    return (isinstance(err, pyodbc.Error) and len(err.args) > 0 and
+            err.args[0] in TRANSIENT_STATES)
+
+
+def retry(function, retries=RETRIES, backoff=BACKOFF):
+    """ Calls function, retrying transient ODBC errors with exponential
+    backoff. Only use it for work that is safe to repeat."""
+    global _quiet
+    quiet = _quiet
+    try:
+        for attempt in range(retries + 1):
+            _quiet = attempt < retries
+            try:
+                return function()
+            except pyodbc.Error as err:
+                if not is_transient(err) or attempt == retries:
+                    raise
+                sys.stderr.write("Database error, retrying: {}\n".format(err))
+                time.sleep(backoff * 2**attempt)
+    finally:
+        _quiet = quiet
+
+
+def connect(connect_string):
+    """ Opens an ODBC connection. Fails fast while the circuit breaker is
+    open."""
+    breaker.check()
+    try:
+        connection = pyodbc.connect(connect_string)
+    except pyodbc.Error as err:
+        if is_transient(err):
+            breaker.failure()
+        raise
+    breaker.success()
+    connection.setdecoding(pyodbc.SQL_CHAR, encoding='utf-8')
+    connection.setdecoding(pyodbc.SQL_WCHAR, encoding='utf-8')
+    connection.setencoding('utf-8')
+    return connection
 
 
 def open_connection(connect_string):
     """ Opens an ODBC connection and returns the connection using a connect
     string."""
     try:
-        connection = pyodbc.connect(connect_string)
-    except:
-        tk.messagebox.showerror(TITLE, "Could not connect to database.")
+        connection = connect(connect_string)
+    except (pyodbc.Error, CircuitOpenError):
+        show_error("Could not connect to database.")
         return
 
-    connection.setdecoding(pyodbc.SQL_CHAR, encoding='utf-8')
-    connection.setdecoding(pyodbc.SQL_WCHAR, encoding='utf-8')
-    connection.setencoding('utf-8')
+    if profiling.is_enabled():
+        connection = profiling.ProfilingConnection(connection)
     return connection
 
 
@@ -34,21 +139,30 @@ def yield_connection(connect_string, commit=False):
     """ Yields a connection generator so that the connection can be used with
     the with syntax."""
     try:
-        connection = pyodbc.connect(connect_string)
-    except:
-        tk.messagebox.showerror(TITLE, "Could not connect to database.")
-        return
+        connection = connect(connect_string)
+    except pyodbc.Error:
+        # Only show the error once retry() has given up.
+        if not _quiet:
+            show_error("Could not connect to database.")
+        raise
+    except CircuitOpenError:
+        show_error("Could not connect to database.")
+        raise
 
-    connection.setdecoding(pyodbc.SQL_CHAR, encoding='utf-8')
-    connection.setdecoding(pyodbc.SQL_WCHAR, encoding='utf-8')
-    connection.setencoding('utf-8')
     cursor = connection.cursor()
+    if profiling.is_enabled():
+        cursor = profiling.ProfilingCursor(cursor)
     try:
         yield cursor
     except pyodbc.DatabaseError as err:
-        error, = err.args
-        sys.stderr.write(error.message)
-        cursor.execute("ROLLBACK")
+        if is_transient(err):
+            breaker.failure()
+        sys.stderr.write("{}\n".format(err))
+        try:
+            connection.rollback()
+        except pyodbc.Error:
+            # The connection is gone, so the server has rolled back.
+            pass
         raise err
     else:
         if commit:
@@ -62,22 +176,22 @@ def yield_connection(connect_string, commit=False):
         connection.close()
 
 
-def stalmic_connection(commit=False):
-    """ Yields a connection to the Stalmic SQL server."""
+def get_connect_string():
+    """ Returns the connect string for the Stalmic SQL server."""
     config = get_config()
-    connect_string = 'DRIVER={{SQL Server}};SERVER={};DATABASE={};\
+    return 'DRIVER={{SQL Server}};SERVER={};DATABASE={};\
             UID={};PWD={}'.format(config[0], config[1],
                                   config[2], config[3])
-    return yield_connection(connect_string, commit)
+
+
+def stalmic_connection(commit=False):
+    """ Yields a connection to the Stalmic SQL server."""
+    return yield_connection(get_connect_string(), commit)
 
 
 def get_stalmic_connection():
     """ Returns a connection to the Stalmic SQL server."""
-    config = get_config()
-    connect_string = 'DRIVER={{SQL Server}};SERVER={};DATABASE={};\
-            UID={};PWD={}'.format(config[0], config[1],
-                                  config[2], config[3])
-    return open_connection(connect_string)
+    return open_connection(get_connect_string())
 
 
 def get_id(value, table, column):
@@ -87,13 +201,11 @@ def get_id(value, table, column):
     assert (column == 'CustomerNum' or column == 'InventoryNum' or
             column == 'VendorNum'), ("Column name not in whitelist "
                                      "(CustomerNum, InventoryNum, VendorNum).")
-    with stalmic_connection() as cursor:
-        command = 'SELECT * FROM {} WHERE {} = ?'.format(table, column)
-        cursor.execute(command, value)
-        try:
-            return cursor.fetchone()[0]
-        except TypeError:
-            return None
+    command = 'SELECT * FROM {} WHERE {} = ?'.format(table, column)
+    try:
+        return statements.fetchone(command, value)[0]
+    except TypeError:
+        return None
 
 
 def get_value_by_id(id, table, column, id_column):
@@ -108,91 +220,582 @@ def get_value_by_id(id, table, column, id_column):
             id_column == 'VendorID' or id_column == 'EquipmentRecordsID'), (
             "ID column name not in whitelist "
             "(CustomerID, InventoryID, VendorID).")
-    with stalmic_connection() as cursor:
-        command = 'SELECT {} FROM {} WHERE {} = ?'.format(column, table,
-                                                          id_column)
-        print(command, id)
-        cursor.execute(command, id)
+    command = 'SELECT {} FROM {} WHERE {} = ?'.format(column, table,
+                                                      id_column)
+    print(command, id)
+    try:
+        return statements.fetchone(command, id)[0]
+    except TypeError:
+        return None
+
+
+def chunks(items, size=MAX_PARAMETERS):
+    """ Splits a list into chunks that fit in a single statement."""
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i+size]
+
+
+def placeholders(count):
+    return ', '.join('?' * count)
+
+
+EQUIPMENT_COMMAND = '''
+SELECT EquipmentRecords.InventoryID, SerialNumber, StalmicPurchase,
+ServiceAgreement, EquipmentRecords.CustomerID, InvoiceDate,
+EquipmentRecords.VendorID, PurchaseDate, EquipmentRecordsID
+FROM EquipmentRecords
+LEFT JOIN Customer
+ON EquipmentRecords.CustomerID = Customer.CustomerID
+LEFT JOIN Inventory
+ON EquipmentRecords.InventoryID = Inventory.InventoryID
+'''
+# Sort orders for EquipmentList, by name. 'default' keeps empty values last
+# for display, which stops the server from reading the rows in index order;
+# the others sort on plain columns so an index can provide the order.
+EQUIPMENT_ORDERS = {
+    'default': '''
+ORDER BY CASE WHEN CustomerNum IS NULL THEN 1 ELSE 0 END, CustomerNum,
+CASE WHEN InventoryNum IS NULL THEN 1 ELSE 0 END, InventoryNum,
+CASE WHEN InvoiceDate IS NULL THEN 1 ELSE 0 END, InvoiceDate,
+CASE WHEN SerialNumber IS NULL OR SerialNumber = '' THEN 1 ELSE 0 END,
+SerialNumber
+''',
+    'customer': 'ORDER BY CustomerNum, InventoryNum, InvoiceDate, '
+                'SerialNumber',
+    'model': 'ORDER BY InventoryNum, CustomerNum, InvoiceDate, SerialNumber',
+    'serial': 'ORDER BY SerialNumber, EquipmentRecordsID',
+    'invoice-date': 'ORDER BY InvoiceDate DESC, EquipmentRecordsID DESC',
+    'purchase-date': 'ORDER BY PurchaseDate DESC, EquipmentRecordsID DESC',
+    'id': 'ORDER BY EquipmentRecordsID',
+}
+
+
+@functools.lru_cache(maxsize=256)
+def select_command(predicates, order='default'):
+    """ Returns the EquipmentList SELECT for a tuple of WHERE predicates and
+    the name of a sort order, or None for no ORDER BY."""
+    command = EQUIPMENT_COMMAND
+    if predicates:
+        command += 'WHERE ' + ' AND '.join(predicates)
+    if order is not None:
+        command += '\n' + EQUIPMENT_ORDERS[order]
+    return command
+
+
+@functools.lru_cache(maxsize=256)
+def update_command(columns):
+    """ Returns the UPDATE of EquipmentRecords setting a tuple of columns."""
+    return '''
+    UPDATE EquipmentRecords SET {}
+    WHERE EquipmentRecordsID = ?'''.format(
+        ', '.join('{} = ?'.format(x) for x in columns))
+
+
+def in_list(ids):
+    """ Returns the placeholders for an IN list and the IDs to go with them.
+    The list is padded to a power of two by repeating the last ID, so only a
+    handful of statement shapes are ever sent."""
+    ids = list(ids)
+    size = 1
+    while size < len(ids):
+        size *= 2
+    size = min(size, MAX_PARAMETERS)
+    if len(ids) < size:
+        ids += [ids[-1]] * (size - len(ids))
+    return placeholders(len(ids)), ids
+
+
+class StatementCache:
+    """ Keeps a long-lived connection with a cursor for each statement, so
+    repeated statements reuse the server's prepared plan instead of being
+    compiled again. The connection is in autocommit mode, so it should only
+    be given single statements."""
+    def __init__(self, maxsize=32):
+        self.maxsize = maxsize
+        self.connection = None
+        self.cursors = collections.OrderedDict()
+
+    def execute(self, command, vars=()):
+        """ Executes a statement and returns the number of rows affected.
+        Transient errors are retried on a new connection."""
+        return retry(lambda: self._run(command, vars))
+
+    def fetchall(self, command, vars=()):
+        """ Executes a statement and returns all of its rows."""
+        return retry(lambda: self._run(command, vars, True))
+
+    def fetchone(self, command, vars=()):
+        """ Executes a statement and returns its first row, or None."""
+        rows = self.fetchall(command, vars)
+        return rows[0] if rows else None
+
+    def _run(self, command, vars, fetch=False):
+        if self.connection is None:
+            self.connection = connect(get_connect_string())
+            if profiling.is_enabled():
+                self.connection = profiling.ProfilingConnection(
+                    self.connection)
+            self.connection.autocommit = True
+        cursor = self.cursors.get(command)
+        if cursor is None:
+            cursor = self.connection.cursor()
+            self.cursors[command] = cursor
+            while len(self.cursors) > self.maxsize:
+                self.cursors.popitem(last=False)[1].close()
+        self.cursors.move_to_end(command)
         try:
-            return cursor.fetchone()[0]
-        except TypeError:
-            return None
+            cursor.execute(command, vars)
+            result = cursor.fetchall() if fetch else cursor.rowcount
+            # The driver allows one active statement per connection, so read
+            # to the end of the results before another cursor is used.
+            while cursor.nextset():
+                pass
+            return result
+        except pyodbc.Error as err:
+            # The connection may have gone bad, start again next time.
+            if is_transient(err):
+                breaker.failure()
+                self.close()
+            raise
 
+    def close(self):
+        for cursor in self.cursors.values():
+            try:
+                cursor.close()
+            except pyodbc.Error:
+                pass
+        self.cursors.clear()
+        if self.connection is not None:
+            try:
+                self.connection.close()
+            except pyodbc.Error:
+                pass
+            self.connection = None
+
+
+statements = StatementCache()
+
+
+RECORD_STATE_COMMAND = '''
+SELECT EquipmentRecordsID, SerialNumber, InventoryNum, CustomerNum,
+EquipmentRecords.InventoryID, EquipmentRecords.CustomerID, StalmicPurchase,
+ServiceAgreement, InvoiceDate, PurchaseDate
+FROM EquipmentRecords
+LEFT JOIN Customer
+ON EquipmentRecords.CustomerID = Customer.CustomerID
+LEFT JOIN Inventory
+ON EquipmentRecords.InventoryID = Inventory.InventoryID
+'''
+RECORD_STATE_COLUMNS = ('ID', 'SerialNumber', 'InventoryNum', 'CustomerNum',
+                        'InventoryID', 'CustomerID', 'StalmicPurchase',
+                        'ServiceAgreement', 'InvoiceDate', 'PurchaseDate')
+
+# How often, in seconds, the in-memory indexes are checked for changes made
+# by other users and jobs.
+INDEX_CHECK_INTERVAL = 60
+# Changes when records are added, deleted or edited, or a customer or model
+# number they refer to is renamed.
+INDEX_FINGERPRINT_COMMAND = '''
+SELECT COUNT(*), MAX(EquipmentRecordsID),
+CHECKSUM_AGG(BINARY_CHECKSUM(EquipmentRecordsID, SerialNumber, InventoryID,
+CustomerID)),
+(SELECT CHECKSUM_AGG(BINARY_CHECKSUM(CustomerID, CustomerNum))
+ FROM Customer),
+(SELECT CHECKSUM_AGG(BINARY_CHECKSUM(InventoryID, InventoryNum))
+ FROM Inventory)
+FROM EquipmentRecords
+'''
+_fingerprint = None
+_checked = None
+
+
+def get_fingerprint():
+    return tuple(statements.fetchone(INDEX_FINGERPRINT_COMMAND))
+
+
+def check_indexes():
+    """ Drops the in-memory indexes, and the results found with them, if
+    EquipmentRecords has changed since they were loaded. Only asks the
+    server once every INDEX_CHECK_INTERVAL seconds."""
+    global _search_index, _serial_index, _fingerprint, _checked
+    now = time.monotonic()
+    if _checked is not None and now - _checked < INDEX_CHECK_INTERVAL:
+        return
+    _checked = now
+    fingerprint = get_fingerprint()
+    if fingerprint != _fingerprint:
+        _fingerprint = fingerprint
+        _search_index = None
+        _serial_index = None
+        EquipmentList.cache.clear()
+
+
+_search_index = None
+
+
+def get_search_index():
+    """ Returns the n-gram search index, loading it on first use and again
+    after EquipmentRecords has been changed elsewhere."""
+    global _search_index
+    check_indexes()
+    if _search_index is None:
+        rows = statements.fetchall(RECORD_STATE_COMMAND)
+        _search_index = EquipmentSearchIndex(x[:4] for x in rows)
+    return _search_index
+
+
+_serial_index = None
 
-def write_to_notes():
-    with stalmic_connection() as cursor:
-        command = '''
-        UPDATE Note SET NoteText = '--EQUIPMENT--'
-        WHERE NoteText LIKE '--EQUIPMENT--%'
-        '''
-        cursor.execute(command)
-        command = '''
-        SELECT RecordID, NoteID, NoteText FROM Note
-        WHERE ModuleCode = 'Customer' AND NoteText LIKE '--EQUIPMENT--%'
-        '''
-        cursor.execute(command)
-        _notes = cursor.fetchall()
-        notes = {}
-        for item in _notes:
-            notes[item[0]] = [item[1], item[2]]
 
+def get_serial_index():
+    """ Returns the serial number index, loading it on first use and again
+    after EquipmentRecords has been changed elsewhere."""
+    global _serial_index
+    check_indexes()
+    if _serial_index is None:
         command = '''
-        SELECT CustomerID, InventoryNum, SerialNumber, InvoiceDate, PurchaseDate,
-        StalmicPurchase, ServiceAgreement
-        FROM EquipmentRecords
-        INNER JOIN Inventory
-        ON EquipmentRecords.InventoryID = Inventory.InventoryID
+        SELECT EquipmentRecordsID, SerialNumber FROM EquipmentRecords
+        WHERE SerialNumber <> '' AND SerialNumber IS NOT NULL
         '''
-        cursor.execute(command)
-        equipment = cursor.fetchall()
-    for record in equipment:
+        _serial_index = SerialIndex(statements.fetchall(command))
+    return _serial_index
+
+
+def get_duplicate_serials():
+    """ Returns (serial, IDs) for every serial number on more than one
+    record, sorted by serial."""
+    return sorted(get_serial_index().get_duplicates().items())
+
+
+def as_date(value):
+    """ Converts a date, datetime or date string to a date for comparisons.
+    """
+    if isinstance(value, str):
+        value = dateutil.parser.parse(value)
+    if isinstance(value, datetime.datetime):
+        value = value.date()
+    return value
+
+
+# Date range filters: (column, whether it is the start of the range).
+DATE_RANGES = {
+    'InvoiceDateFrom': ('InvoiceDate', True),
+    'InvoiceDateTo': ('InvoiceDate', False),
+    'PurchaseDateFrom': ('PurchaseDate', True),
+    'PurchaseDateTo': ('PurchaseDate', False),
+}
+
+
+def filter_matches(key, state):
+    """ Whether a record's state (a row of RECORD_STATE_COMMAND) matches the
+    filters of an EquipmentList cache key. Errs on the side of matching."""
+    state = dict(zip(RECORD_STATE_COLUMNS, state))
+    for column, value in key:
+        if column == 'order':
+            continue
+        elif column == 'IDs':
+            if state['ID'] not in value:
+                return False
+        elif column in ('SerialNumber', 'InventoryNum', 'CustomerNum'):
+            if not is_supported(value):
+                continue
+            if (state[column] is None or
+                    not like_to_regex(value).fullmatch(fold(state[column]))):
+                return False
+        elif column in DATE_RANGES:
+            base, after = DATE_RANGES[column]
+            try:
+                if state[base] is None:
+                    return False
+                if after:
+                    if as_date(state[base]) < as_date(value):
+                        return False
+                elif as_date(state[base]) > as_date(value):
+                    return False
+            except (ValueError, OverflowError):
+                continue
+        elif column in ('InvoiceDate', 'PurchaseDate'):
+            try:
+                if state[column] is None or \
+                        as_date(state[column]) != as_date(value):
+                    return False
+            except (ValueError, OverflowError):
+                continue
+        elif column in ('StalmicPurchase', 'ServiceAgreement'):
+            if bool(state[column]) != value:
+                return False
+        elif state[column] != value:
+            return False
+    return True
+
+
+def records_changed(ids, deleted=False):
+    """ Updates the search index and the EquipmentList cache after
+    EquipmentRecords have been written. Must be called after the write is
+    committed."""
+    ids = set(ids)
+    if not ids:
+        return
+    # Cached results that contained the records are out of date...
+    EquipmentList.cache.invalidate(
+        lambda key, value: not ids.isdisjoint(value[1]))
+    for index in (_search_index, _serial_index):
+        if index is not None:
+            for id in ids:
+                index.remove(id)
+    if deleted or (_search_index is None and _serial_index is None and
+                   not len(EquipmentList.cache)):
+        refresh_fingerprint()
+        return
+    states = []
+    for chunk in chunks(ids):
+        in_string, chunk = in_list(chunk)
+        command = RECORD_STATE_COMMAND + \
+            'WHERE EquipmentRecordsID IN ({})'.format(in_string)
+        states.extend(statements.fetchall(command, chunk))
+    for state in states:
+        if _search_index is not None:
+            _search_index.update(*state[:4])
+        if _serial_index is not None:
+            _serial_index.add(state[0], state[1])
+    # ...and so are the ones the records match now.
+    EquipmentList.cache.invalidate(
+        lambda key, value: any(filter_matches(key, x) for x in states))
+    refresh_fingerprint()
+
+
+def refresh_fingerprint():
+    """ Records the current fingerprint after this process has written
+    EquipmentRecords and patched the indexes itself, so check_indexes()
+    doesn't reload them for our own changes. A change made elsewhere since
+    the last check is taken in with it and is only seen after the next
+    one."""
+    global _fingerprint, _checked
+    if _fingerprint is None:
+        return
+    _fingerprint = get_fingerprint()
+    _checked = time.monotonic()
+
+
+def delete_records(ids):
+    """ Deletes EquipmentRecords by ID."""
+    ids = list(ids)
+
+    def write():
+        with stalmic_connection(True) as cursor:
+            for chunk in chunks(ids):
+                in_string, chunk = in_list(chunk)
+                command = '''
+                DELETE FROM EquipmentRecords
+                WHERE EquipmentRecordsID IN ({})'''.format(in_string)
+                cursor.execute(command, chunk)
+    # Deleting again is harmless, so a lost connection can be retried.
+    retry(write)
+    records_changed(ids, deleted=True)
+
+
+def bulk_update(ids, **columns):
+    """ Sets the same columns on many EquipmentRecords in one transaction."""
+    assert UnitOfWork.UPDATE_COLUMNS.issuperset(columns), (
+        "Column name not in whitelist ({}).".format(
+            ', '.join(sorted(UnitOfWork.UPDATE_COLUMNS))))
+    ids = list(ids)
+    if not ids or not columns:
+        return
+    names = list(columns)
+    values = [columns[x] for x in names]
+
+    def write():
+        with stalmic_connection(True) as cursor:
+            for chunk in chunks(ids, MAX_PARAMETERS - len(values)):
+                in_string, chunk = in_list(chunk)
+                command = '''
+                UPDATE EquipmentRecords SET {}
+                WHERE EquipmentRecordsID IN ({})'''.format(
+                    ', '.join('{} = ?'.format(x) for x in names), in_string)
+                cursor.execute(command, values + chunk)
+    retry(write)
+    records_changed(ids)
+
+
+def fetch_rows(cursor, size=BATCH_SIZE):
+    """ Yields the rows of an executed query, fetching size rows at a time.
+    """
+    while True:
+        rows = cursor.fetchmany(size)
+        if not rows:
+            return
+        yield from rows
+
+
+def note_line(record):
+    """ Formats a row of NOTE_EQUIPMENT_COMMAND for a customer note."""
+    try:
+        note = "\n{} #{}, {}\n ".format(record[1], record[2],
+        record[3].strftime('%#m/%#d/%y'))
+    except AttributeError:
         try:
             note = "\n{} #{}, {}\n ".format(record[1], record[2],
-            record[3].strftime('%#m/%#d/%y'))
+            record[4].strftime('%#m/%#d/%y'))
         except AttributeError:
-            try:
-                note = "\n{} #{}, {}\n ".format(record[1], record[2],
-                record[4].strftime('%#m/%#d/%y'))
-            except AttributeError:
-                note = "\n{} #{}\n ".format(record[1], record[2])
-        if record[5]:
-            note += "StalPur"
-        else:
-            note += "NOT STALPUR"
-        if record[6]:
-            note += "  ServAgr"
-        else:
-            note += "  NO SERVAGR"
+            note = "\n{} #{}\n ".format(record[1], record[2])
+    if record[5]:
+        note += "StalPur"
+    else:
+        note += "NOT STALPUR"
+    if record[6]:
+        note += "  ServAgr"
+    else:
+        note += "  NO SERVAGR"
+    return note
+
+
+NOTE_EQUIPMENT_COMMAND = '''
+SELECT CustomerID, InventoryNum, SerialNumber, InvoiceDate, PurchaseDate,
+StalmicPurchase, ServiceAgreement
+FROM EquipmentRecords
+INNER JOIN Inventory
+ON EquipmentRecords.InventoryID = Inventory.InventoryID
+WHERE CustomerID IS NOT NULL
+ORDER BY CustomerID, EquipmentRecordsID
+'''
+
+
+def customer_notes(cursor, existing):
+    """ Yields (CustomerID, NoteID, NoteText) for each customer as soon as the
+    last of its rows has been read. cursor must have run
+    NOTE_EQUIPMENT_COMMAND. existing maps CustomerIDs to the NoteIDs of their
+    equipment notes; NoteID is None for customers without one, and customers
+    with a note but no equipment are given an empty note."""
+    existing = dict(existing)
+    for customer_id, records in itertools.groupby(fetch_rows(cursor),
+                                                  key=lambda x: x[0]):
+        text = "--EQUIPMENT--" + ''.join(note_line(x) for x in records)
+        yield customer_id, existing.pop(customer_id, None), text
+    for customer_id, note_id in existing.items():
+        yield customer_id, note_id, "--EQUIPMENT--"
+
+
+class NoteWriter(threading.Thread):
+    """ Writes customer notes on its own connection while they are still
+    being generated. Everything is written in one transaction, which is only
+    committed by close()."""
+    # Queued to roll back instead of committing.
+    ABORT = object()
+
+    def __init__(self, size=BATCH_SIZE):
+        super().__init__(daemon=True)
+        self.queue = queue.Queue(size)
+        self.error = None
+        # Connect here so a connection error is raised to the caller.
+        self.connection = connect(get_connect_string())
+
+    def run(self):
+        cursor = self.connection.cursor()
         try:
-            notes[record[0]][1] += note
-        except KeyError:
-            notes[record[0]] = [False, "--EQUIPMENT--" + note]
+            for note in iter(self.queue.get, None):
+                if note is self.ABORT:
+                    self.connection.rollback()
+                    return
+                customer_id, note_id, text = note
+                if note_id is None:
+                    command = '''
+                    INSERT INTO Note (ModuleCode, RecordID, NoteText,
+                    SendToDevice, AlwaysSendToDevice, NoteDate)
+                    VALUES ('Customer', ?, ?, 1, 1, GETDATE())
+                    '''
+                    cursor.execute(command, (customer_id, text))
+                else:
+                    command = '''
+                    UPDATE Note
+                    SET NoteText = ?
+                    WHERE NoteID = ?
+                    '''
+                    cursor.execute(command, (text, note_id))
+            # Clean up
+            command = '''
+            DELETE FROM Note
+            WHERE NoteText = '--EQUIPMENT--'
+            '''
+            cursor.execute(command)
+            self.connection.commit()
+        except Exception as err:
+            self.error = err
+            if is_transient(err):
+                breaker.failure()
+            try:
+                self.connection.rollback()
+            except pyodbc.Error:
+                pass
+        finally:
+            self.connection.close()
 
-    with stalmic_connection(True) as cursor:
-        for x in notes:
-            if not notes[x][0]:
-                command = '''
-                INSERT INTO Note (ModuleCode, RecordID, NoteText, SendToDevice,
-                AlwaysSendToDevice, NoteDate)
-                VALUES ('Customer', ?, ?, 1, 1, GETDATE())
-                '''
-                cursor.execute(command, (x, notes[x][1]))
-            else:
-                command = '''
-                UPDATE Note
-                SET NoteText = ?
-                WHERE NoteID = ?
-                '''
-                cursor.execute(command, (notes[x][1], notes[x][0]))
-    # Clean up
-    with stalmic_connection(True) as cursor:
+    def put(self, note):
+        """ Queues a note to be written. Returns False if the writer has
+        stopped because of an error."""
+        while self.is_alive():
+            try:
+                self.queue.put(note, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def close(self, commit=True):
+        """ Waits for the queued notes to be written and commits them, or
+        rolls them back if commit is false. Raises the writer's error if it
+        failed."""
+        self.put(None if commit else self.ABORT)
+        self.join()
+        if commit and self.error is not None:
+            raise self.error
+
+
+def write_to_notes(progress=None, cancel=None):
+    """ Pushes the equipment records into each customer's notes. Returns the
+    number of customer notes written. See the progress module for progress
+    and cancel; a cancelled push writes nothing.
+
+    The equipment is read in CustomerID order and each customer's note is
+    handed to a NoteWriter as soon as it is complete, so reading and writing
+    overlap and only one customer's rows are held at a time."""
+    count = 0
+    with stalmic_connection() as cursor:
+        command = '''
+        SELECT RecordID, NoteID FROM Note
+        WHERE ModuleCode = 'Customer' AND NoteText LIKE '--EQUIPMENT--%'
+        '''
+        cursor.execute(command)
+        existing = {x[0]: x[1] for x in cursor.fetchall()}
+        # Every customer with equipment or an equipment note gets a note.
         command = '''
-        DELETE FROM Note
-        WHERE NoteText = '--EQUIPMENT--'
+        SELECT COUNT(*) FROM (
+            SELECT CustomerID FROM EquipmentRecords
+            WHERE CustomerID IS NOT NULL
+            UNION
+            SELECT RecordID FROM Note
+            WHERE ModuleCode = 'Customer' AND NoteText LIKE '--EQUIPMENT--%'
+        ) AS Customers
         '''
         cursor.execute(command)
+        tracker = Progress(progress, cursor.fetchone()[0])
+        cursor.execute(NOTE_EQUIPMENT_COMMAND)
+        writer = NoteWriter()
+        writer.start()
+        try:
+            for note in in_batches(customer_notes(cursor, existing), tracker,
+                                   cancel):
+                if not writer.put(note):
+                    break
+                count += 1
+        except BaseException:
+            writer.close(commit=False)
+            raise
+        writer.close()
 
-    tk.messagebox.showinfo(TITLE, "Successfully pushed.")
+    show_info("Successfully pushed.")
+    return count
 
 
 class EquipmentRecord:
@@ -286,50 +889,60 @@ class EquipmentRecord:
     def add_record(self):
         with stalmic_connection(True) as cursor:
             command = '''
-            INSERT INTO EquipmentRecords VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            INSERT INTO EquipmentRecords
+            OUTPUT INSERTED.EquipmentRecordsID
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
             '''
             cursor.execute(command, (self.InventoryID, self.CustomerID,
                                      self.VendorID, self.PurchaseDate,
                                      self.InvoiceDate, self.SerialNumber,
                                      self.StalmicPurchase,
                                      self.ServiceAgreement))
+            self.ID = cursor.fetchone()[0]
+        records_changed([self.ID])
 
-    def edit_record(self):
-        command = 'UPDATE EquipmentRecords SET'
-        vars = []
-        var_string = []
+    def get_updates(self):
+        """ Returns the (column, value) pairs edit_record() will set."""
+        updates = []
         if self.InventoryID:
-            vars.append(self.InventoryID)
-            var_string.append('InventoryID = ?')
+            updates.append(('InventoryID', self.InventoryID))
         if self.CustomerID:
-            vars.append(self.CustomerID)
-            var_string.append('CustomerID = ?')
+            updates.append(('CustomerID', self.CustomerID))
         if self.VendorID:
-            vars.append(self.VendorID)
-            var_string.append('VendorID = ?')
+            updates.append(('VendorID', self.VendorID))
         if self.PurchaseDate:
-            vars.append(self.PurchaseDate)
-            var_string.append('PurchaseDate = ?')
+            updates.append(('PurchaseDate', self.PurchaseDate))
         if self.InvoiceDate:
-            vars.append(self.InvoiceDate)
-            var_string.append('InvoiceDate = ?')
+            updates.append(('InvoiceDate', self.InvoiceDate))
         if self.SerialNumber:
-            vars.append(self.SerialNumber)
-            var_string.append('SerialNumber = ?')
+            updates.append(('SerialNumber', self.SerialNumber))
         # Have to use "is not None" here because otherwise we can't change
         # these to False.
         if self.StalmicPurchase is not None:
-            vars.append(self.StalmicPurchase)
-            var_string.append('StalmicPurchase = ?')
+            updates.append(('StalmicPurchase', self.StalmicPurchase))
         if self.ServiceAgreement is not None:
-            vars.append(self.ServiceAgreement)
-            var_string.append('ServiceAgreement = ?')
-        command += ' ' + ', '.join(var_string)
-        command += ' WHERE EquipmentRecordsID = ?'
+            updates.append(('ServiceAgreement', self.ServiceAgreement))
+        return updates
+
+    def edit_record(self):
+        updates = self.get_updates()
+        command = update_command(tuple(x[0] for x in updates))
+        vars = [x[1] for x in updates]
         vars.append(self.ID)
         if len(vars) > 1:
-            with stalmic_connection(True) as cursor:
-                cursor.execute(command, vars)
+            # A single statement, so the autocommit connection is safe.
+            statements.execute(command, vars)
+            records_changed([self.ID])
+
+    def get_state(self):
+        """ Returns the record's columns as a tuple."""
+        return (self.ID, self.InventoryID, self.SerialNumber,
+                self.StalmicPurchase, self.ServiceAgreement, self.CustomerID,
+                self.InvoiceDate, self.VendorID, self.PurchaseDate)
+
+    def same_as(self, other):
+        """ Whether another EquipmentRecord has the same values."""
+        return self.get_state() == other.get_state()
 
     def __repr__(self):
         return str((self.ID, self.InventoryID, self.SerialNumber,
@@ -338,11 +951,150 @@ class EquipmentRecord:
                     self.PurchaseDate))
 
 
+def fetch_record(id):
+    """ Returns the EquipmentRecord with an ID, or None if it doesn't exist.
+    Only reads EquipmentRecords by primary key, so it is cheap."""
+    command = '''
+    SELECT InventoryID, SerialNumber, StalmicPurchase, ServiceAgreement,
+    CustomerID, InvoiceDate, VendorID, PurchaseDate, EquipmentRecordsID
+    FROM EquipmentRecords WHERE EquipmentRecordsID = ?
+    '''
+    row = statements.fetchone(command, id)
+    return None if row is None else EquipmentRecord(*row)
+
+
+class UnitOfWork:
+    """ Collects inserts, updates and deletes against EquipmentRecords and
+    writes them in one transaction. Updates to the same record are merged,
+    and updates setting the same columns are sent with one executemany.
+
+        with UnitOfWork() as work:
+            work.update(id, PurchaseDate=date)
+
+    If an ImportLedger is given, its pending hashes are written in the same
+    transaction, so the ledger never disagrees with the records."""
+    # Columns of an INSERT, in table order.
+    INSERT_COLUMNS = ('InventoryID', 'CustomerID', 'VendorID', 'PurchaseDate',
+                      'InvoiceDate', 'SerialNumber', 'StalmicPurchase',
+                      'ServiceAgreement')
+    # Column names are put into the SQL, so only allow these.
+    UPDATE_COLUMNS = set(INSERT_COLUMNS)
+
+    def __init__(self, ledger=None):
+        self.ledger = ledger
+        self.inserts = []
+        self.updates = {}
+        self.deletes = set()
+
+    def add(self, record):
+        """ Queues an EquipmentRecord to be inserted."""
+        self.inserts.append(record)
+
+    def edit(self, record):
+        """ Queues the same update as EquipmentRecord.edit_record()."""
+        self.update(record.ID, **dict(record.get_updates()))
+
+    def update(self, id, **columns):
+        """ Queues columns to be set on a record. Later updates to the same
+        record override earlier ones."""
+        assert self.UPDATE_COLUMNS.issuperset(columns), (
+            "Column name not in whitelist ({}).".format(
+                ', '.join(sorted(self.UPDATE_COLUMNS))))
+        if id in self.deletes or not columns:
+            return
+        self.updates.setdefault(id, {}).update(columns)
+
+    def delete(self, id):
+        """ Queues a record to be deleted, dropping any pending updates."""
+        self.updates.pop(id, None)
+        self.deletes.add(id)
+
+    def __len__(self):
+        return len(self.inserts) + len(self.updates) + len(self.deletes)
+
+    def flush(self):
+        """ Writes everything queued in one transaction."""
+        hashes = self.ledger is not None and self.ledger.pending
+        if not len(self) and not hashes:
+            return
+        # Group updates by the columns they set.
+        shapes = {}
+        for id, columns in self.updates.items():
+            shape = tuple(sorted(columns))
+            shapes.setdefault(shape, []).append(
+                [columns[x] for x in shape] + [id])
+
+        def write():
+            inserted = []
+            with stalmic_connection(True) as cursor:
+                cursor.fast_executemany = True
+                # Inserts use multi-row VALUES rather than executemany so
+                # that OUTPUT can return the new IDs.
+                rows = len(self.INSERT_COLUMNS)
+                for chunk in chunks(self.inserts, MAX_PARAMETERS // rows):
+                    command = '''
+                    INSERT INTO EquipmentRecords
+                    OUTPUT INSERTED.EquipmentRecordsID
+                    VALUES {}'''.format(', '.join(
+                        ['({})'.format(placeholders(rows))] * len(chunk)))
+                    vars = []
+                    for record in chunk:
+                        vars.extend(getattr(record, x)
+                                    for x in self.INSERT_COLUMNS)
+                    cursor.execute(command, vars)
+                    inserted.extend(x[0] for x in cursor.fetchall())
+                for shape, vars in shapes.items():
+                    cursor.executemany(update_command(shape), vars)
+                if self.deletes:
+                    command = '''
+                    DELETE FROM EquipmentRecords
+                    WHERE EquipmentRecordsID = ?'''
+                    cursor.executemany(command,
+                                       [(x,) for x in self.deletes])
+                if hashes:
+                    self.ledger.write(cursor)
+            return inserted
+
+        if self.inserts or hashes:
+            # An insert that may or may not have been committed can't be
+            # safely repeated.
+            inserted = write()
+        else:
+            inserted = retry(write)
+        if hashes:
+            self.ledger.pending = []
+        records_changed(inserted + list(self.updates))
+        records_changed(self.deletes, deleted=True)
+        self.inserts = []
+        self.updates = {}
+        self.deletes = set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        # Only write if the block finished without an error.
+        if type is None:
+            self.flush()
+
+
 class EquipmentList:
+    # Whether LIKE searches are resolved with the in-memory n-gram index.
+    use_search_index = True
+    # Results of recent searches, keyed by get_key().
+    cache = ResultCache()
+
     def __init__(self, CustomerID=None, InventoryID=None, SerialNumber=None,
                  CustomerNum=None, InventoryNum=None, StalmicPurchase=None,
                  ServiceAgreement=None, InvoiceDate=None, PurchaseDate=None,
-                 ID=None):
+                 ID=None, IDs=None, InvoiceDateFrom=None, InvoiceDateTo=None,
+                 PurchaseDateFrom=None, PurchaseDateTo=None,
+                 order_by='default'):
+        """ Searches EquipmentRecords. StalmicPurchase and ServiceAgreement
+        match any value when None. The date ranges include both ends, and
+        order_by is a name from EQUIPMENT_ORDERS, or None for no order."""
+        if order_by is not None and order_by not in EQUIPMENT_ORDERS:
+            raise ValueError("Unknown sort order: {}".format(order_by))
         self.CustomerID = CustomerID
         self.InventoryID = InventoryID
         self.SerialNumber = SerialNumber
@@ -353,41 +1105,98 @@ class EquipmentList:
         self.InventoryNum = InventoryNum
         self.InvoiceDate = InvoiceDate
         self.PurchaseDate = PurchaseDate
+        self.InvoiceDateFrom = InvoiceDateFrom
+        self.InvoiceDateTo = InvoiceDateTo
+        self.PurchaseDateFrom = PurchaseDateFrom
+        self.PurchaseDateTo = PurchaseDateTo
         self.ID = ID
-        # Build the SELECT statement.
-        equipment_command = '''
-        SELECT EquipmentRecords.InventoryID, SerialNumber, StalmicPurchase,
-        ServiceAgreement, EquipmentRecords.CustomerID, InvoiceDate,
-        EquipmentRecords.VendorID, PurchaseDate, EquipmentRecordsID
-        FROM EquipmentRecords
-        LEFT JOIN Customer
-        ON EquipmentRecords.CustomerID = Customer.CustomerID
-        LEFT JOIN Inventory
-        ON EquipmentRecords.InventoryID = Inventory.InventoryID
-        '''
-        # Build our WHERE statement if there are variables.
+        self.IDs = IDs
+        self.order_by = order_by
+        key = self.get_key()
+        cached = self.cache.get(key)
+        if cached is None:
+            rows = [tuple(x) for x in self.query()]
+            self.cache.put(key, (rows, {x[8] for x in rows}))
+        else:
+            rows = cached[0]
+        self.equipment = [EquipmentRecord(*x) for x in rows]
+
+    def get_key(self):
+        """ Returns the filters in a normalized, hashable form. Filters that
+        are ignored by query() are left out."""
+        filters = {}
+        if self.CustomerNum:
+            filters['CustomerNum'] = fold(self.CustomerNum)
+        elif self.CustomerID:
+            filters['CustomerID'] = self.CustomerID
+        if self.InventoryNum:
+            filters['InventoryNum'] = fold(self.InventoryNum)
+        elif self.InventoryID:
+            filters['InventoryID'] = self.InventoryID
+        if self.SerialNumber:
+            filters['SerialNumber'] = fold(self.SerialNumber)
+        if self.ServiceAgreement is not None:
+            filters['ServiceAgreement'] = bool(self.ServiceAgreement)
+        if self.StalmicPurchase is not None:
+            filters['StalmicPurchase'] = bool(self.StalmicPurchase)
+        if self.InvoiceDate:
+            filters['InvoiceDate'] = self.InvoiceDate
+        if self.PurchaseDate:
+            filters['PurchaseDate'] = self.PurchaseDate
+        for column in DATE_RANGES:
+            if getattr(self, column):
+                filters[column] = getattr(self, column)
+        if self.ID:
+            filters['ID'] = self.ID
+        if self.IDs is not None:
+            filters['IDs'] = frozenset(self.IDs)
+        # The order isn't a filter, but cached rows are kept in it.
+        filters['order'] = self.order_by or ''
+        return tuple(sorted(filters.items()))
+
+    def query(self):
+        """ Runs the search on the server and returns the rows."""
+        ids = self.IDs
+        # Resolve substring searches with the n-gram index so the server
+        # only has to look up primary keys.
+        customer_num = self.CustomerNum
+        inventory_num = self.InventoryNum
+        serial = self.SerialNumber
+        if (self.use_search_index and ids is None and
+                (customer_num or inventory_num or serial)):
+            found = get_search_index().search(CustomerNum=customer_num,
+                                              InventoryNum=inventory_num,
+                                              SerialNumber=serial)
+            if found is not None and len(found) <= MAX_PARAMETERS:
+                ids = found
+                customer_num = inventory_num = serial = None
+        # Build our WHERE statement if there are variables. The predicates
+        # are always added in the same order so that each combination of
+        # filters gives the same statement.
         vars = []
         var_string = []
         if self.CustomerNum:
-            vars.append(self.CustomerNum)
-            var_string.append('CustomerNum LIKE ?')
+            if customer_num:
+                vars.append(customer_num)
+                var_string.append('CustomerNum LIKE ?')
         elif self.CustomerID:
             vars.append(self.CustomerID)
-            var_string.append('CustomerID = ?')
+            var_string.append('EquipmentRecords.CustomerID = ?')
         if self.InventoryNum:
-            vars.append(self.InventoryNum)
-            var_string.append('InventoryNum LIKE ?')
+            if inventory_num:
+                vars.append(inventory_num)
+                var_string.append('InventoryNum LIKE ?')
         elif self.InventoryID:
             vars.append(self.InventoryID)
-            var_string.append('InventoryID = ?')
-        if self.SerialNumber:
-            vars.append(self.SerialNumber)
+            var_string.append('EquipmentRecords.InventoryID = ?')
+        if serial:
+            vars.append(serial)
             var_string.append('SerialNumber LIKE ?')
-        if self.ServiceAgreement:
-            vars.append(self.ServiceAgreement)
+        if self.ServiceAgreement is not None:
+            vars.append(bool(self.ServiceAgreement))
             var_string.append('ServiceAgreement = ?')
-        if self.StalmicPurchase:
-            vars.append(self.StalmicPurchase)
+        if self.StalmicPurchase is not None:
+            vars.append(bool(self.StalmicPurchase))
             var_string.append('StalmicPurchase = ?')
         if self.InvoiceDate:
             vars.append(self.InvoiceDate)
@@ -395,27 +1204,32 @@ class EquipmentList:
         if self.PurchaseDate:
             vars.append(self.PurchaseDate)
             var_string.append('PurchaseDate = ?')
+        for column, (base, after) in DATE_RANGES.items():
+            if getattr(self, column):
+                vars.append(getattr(self, column))
+                var_string.append('{} {} ?'.format(base,
+                                                   '>=' if after else '<='))
         if self.ID:
             vars.append(self.ID)
             var_string.append('EquipmentRecordsID = ?')
-        vars = tuple(vars)
-        # Join them together with AND.
-        var_string = ' AND '.join(var_string)
-        if len(var_string) > 0:
-            equipment_command += 'WHERE '
-            equipment_command += var_string
-        # Sort by Customer for now.
-        equipment_command += '''
-        ORDER BY CASE WHEN CustomerNum IS NULL THEN 1 ELSE 0 END, CustomerNum,
-        CASE WHEN InventoryNum IS NULL THEN 1 ELSE 0 END, InventoryNum,
-        CASE WHEN InvoiceDate IS NULL THEN 1 ELSE 0 END, InvoiceDate,
-        CASE WHEN SerialNumber IS NULL OR SerialNumber = '' THEN 1 ELSE 0 END,
-        SerialNumber
-        '''
-        with stalmic_connection() as cursor:
-            cursor.execute(equipment_command, vars)
-            self.equipment = cursor.fetchall()
-        self.equipment = [EquipmentRecord(*x) for x in self.equipment]
+        wanted = None
+        if ids is not None:
+            if not ids:
+                # Nothing can match an empty ID list.
+                return []
+            if len(ids) > MAX_PARAMETERS:
+                # Too many to send as parameters, so filter the rows here.
+                wanted = set(ids)
+            else:
+                in_string, ids = in_list(sorted(ids))
+                vars.extend(ids)
+                var_string.append(
+                    'EquipmentRecordsID IN ({})'.format(in_string))
+        rows = statements.fetchall(
+            select_command(tuple(var_string), self.order_by), vars)
+        if wanted is not None:
+            rows = [x for x in rows if x[8] in wanted]
+        return rows
 
     def get_equipment(self, connection=False):
         return [x.get_record(connection) for x in self.equipment]
@@ -447,86 +1261,278 @@ class EquipmentList:
         return str(self.equipment)
 
 
-def import_sales_csv(filename):
-    """ Imports sales data from a CSV."""
+# Indexes for the EquipmentList query shapes: (name, table, key columns,
+# included columns). The EquipmentRecords indexes include the columns the
+# SELECT returns so the rows can be read without going back to the table.
+# Key columns are left out of the INCLUDE list, which can't repeat them.
+EQUIPMENT_INCLUDE = ('InventoryID', 'SerialNumber', 'StalmicPurchase',
+                     'ServiceAgreement', 'CustomerID', 'InvoiceDate',
+                     'VendorID', 'PurchaseDate')
+INDEXES = (
+    ('IX_EquipmentRecords_CustomerID', 'EquipmentRecords',
+     ('CustomerID', 'InventoryID', 'InvoiceDate'), EQUIPMENT_INCLUDE),
+    ('IX_EquipmentRecords_InventoryID', 'EquipmentRecords',
+     ('InventoryID', 'CustomerID', 'InvoiceDate'), EQUIPMENT_INCLUDE),
+    ('IX_EquipmentRecords_SerialNumber', 'EquipmentRecords',
+     ('SerialNumber',), EQUIPMENT_INCLUDE),
+    ('IX_EquipmentRecords_InvoiceDate', 'EquipmentRecords',
+     ('InvoiceDate',), EQUIPMENT_INCLUDE),
+    ('IX_EquipmentRecords_PurchaseDate', 'EquipmentRecords',
+     ('PurchaseDate',), EQUIPMENT_INCLUDE),
+    ('IX_Customer_CustomerNum', 'Customer', ('CustomerNum',),
+     ('CustomerID',)),
+    ('IX_Inventory_InventoryNum', 'Inventory', ('InventoryNum',),
+     ('InventoryID',)),
+)
+
+
+def create_indexes():
+    """ Creates any of INDEXES that don't exist yet and returns their names.
+    """
+    created = []
+    with stalmic_connection(True) as cursor:
+        for name, table, columns, include in INDEXES:
+            command = '''
+            SELECT 1 FROM sys.indexes
+            WHERE name = ? AND object_id = OBJECT_ID(?)'''
+            cursor.execute(command, (name, table))
+            if cursor.fetchone() is not None:
+                continue
+            command = 'CREATE INDEX {} ON {} ({})'.format(
+                name, table, ', '.join(columns))
+            include = [x for x in include if x not in columns]
+            if include:
+                command += ' INCLUDE ({})'.format(', '.join(include))
+            cursor.execute(command)
+            created.append(name)
+    return created
+
+
+class ImportLedger:
+    """ Hashes of import rows and units that have already been applied, so
+    overlapping exports can be imported again without duplicating them."""
+    def __init__(self):
+        with stalmic_connection(True) as cursor:
+            command = '''
+            IF OBJECT_ID('ImportLedger') IS NULL
+            CREATE TABLE ImportLedger (
+                Hash CHAR(40) NOT NULL PRIMARY KEY,
+                ImportedAt DATETIME NOT NULL DEFAULT GETDATE())
+            '''
+            cursor.execute(command)
+            cursor.execute('SELECT Hash FROM ImportLedger')
+            self.hashes = {x[0] for x in cursor.fetchall()}
+        self.pending = []
+
+    @staticmethod
+    def hash(kind, *values):
+        """ Hashes a kind of ledger entry and its values."""
+        text = '\x1f'.join([kind] + ['' if x is None else str(x)
+                                      for x in values])
+        return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+    def __contains__(self, hash):
+        return hash in self.hashes
+
+    def add(self, hash):
+        """ Records a hash. It isn't written until save() is called."""
+        if hash not in self.hashes:
+            self.hashes.add(hash)
+            self.pending.append(hash)
+
+    def write(self, cursor):
+        """ Inserts the pending hashes with a cursor, so they can be committed
+        in the same transaction as the work they record. The caller clears
+        pending once the transaction is committed."""
+        if self.pending:
+            command = 'INSERT INTO ImportLedger (Hash) VALUES (?)'
+            cursor.executemany(command, [(x,) for x in self.pending])
+
+    def save(self):
+        if not self.pending:
+            return
+        with stalmic_connection(True) as cursor:
+            self.write(cursor)
+        self.pending = []
+
+
+def get_line_hashes(reader, kind):
+    """ Returns a ledger hash for each CSV line. Identical lines are told
+    apart by how many times they have already appeared in the file."""
+    seen = collections.Counter()
+    hashes = []
+    for item in reader:
+        line = tuple(item)
+        hashes.append(ImportLedger.hash(kind, seen[line], *line))
+        seen[line] += 1
+    return hashes
+
+
+def import_sales_csv(filename, use_ledger=True, skip_duplicates=False,
+                     progress=None, cancel=None):
+    """ Imports sales data from a CSV. Returns the number of records added or
+    removed. Lines and serial numbers already in the import ledger are
+    skipped. Serial numbers already in the database are reported, and
+    skipped if skip_duplicates is true, unless the export credits them,
+    since a returned unit can be sold again. See the progress module for
+    progress and cancel."""
     with open(filename, newline='', encoding='utf-8-sig') as file:
         reader = list(csv.reader(file))
-    for item in reader:
-        if item[0] == 'Invoice' or item[0] == 'Credit Memo':
-            inv_date = None if item[1] == '' else dateutil.parser.parse(item[1])
-            customer_id = get_id(item[2], 'Customer', 'CustomerNum')
-            inv_num = re.search(r'(.+?)(?= \()', item[3])
-            inv_num = inv_num.group(0)
-            item_id = get_id(inv_num, 'Inventory', 'InventoryNum')
-            serial = item[5].split(',')
-            for i in range(int(item[4])):
-                try:
-                    serial[i]
-                except IndexError:
+    export = SalesExport(reader)
+    ledger = ImportLedger() if use_ledger else None
+    line_hashes = get_line_hashes(reader, 'sales')
+    # Each line is looked at once for sales and once for credits.
+    tracker = Progress(progress, 2 * len(export))
+    # Hashes for units are committed along with the units, so a failed
+    # import leaves nothing to save.
+    return _import_sales(export, line_hashes, ledger, skip_duplicates,
+                         tracker, cancel)
+
+
+def _import_sales(export, line_hashes, ledger, skip_duplicates, tracker,
+                  cancel):
+    count = 0
+    serial_hashes = []
+    serial_index = get_serial_index()
+    # Serials queued in this import, which aren't in the index until flushed.
+    serials = set()
+    work = UnitOfWork(ledger)
+    # Look up each customer and model once rather than once per line.
+    customer_ids = {x: get_id(x, 'Customer', 'CustomerNum')
+                    for x in set(export.customer)}
+    item_ids = {x: get_id(x, 'Inventory', 'InventoryNum')
+                for x in set(export.model) if x is not None}
+
+    def flush():
+        # The units' hashes are written in the same transaction as the units.
+        if ledger is not None:
+            for serial_hash in serial_hashes:
+                ledger.add(serial_hash)
+        serial_hashes.clear()
+        work.flush()
+    # Serials credited by this export. Their earlier record is removed by the
+    # credit pass, so selling them again isn't a duplicate.
+    credited = {normalize_serial(x) for x in export.units(credits=True)[0]}
+    # Lines with units that couldn't be applied, which are left out of the
+    # ledger so a later import tries them again.
+    unapplied = set()
+    units, start = export.units()
+    for k in in_batches(range(len(export)), tracker, cancel, flush):
+        if ledger is not None and line_hashes[export.line[k]] in ledger:
+            continue
+        customer = export.customer[k]
+        inv_num = export.model[k]
+        inv_date = export.date[k]
+        customer_id = customer_ids[customer]
+        item_id = item_ids.get(inv_num)
+        if customer_id is None or item_id is None:
+            if start[k] != start[k+1]:
+                unapplied.add(k)
+            continue
+        for serial in units[start[k]:start[k+1]]:
+            # Blank serials can't be told apart, so only the line hash
+            # covers those.
+            serial_hash = None
+            if ledger is not None and serial:
+                serial_hash = ledger.hash('sale', customer, inv_num, serial,
+                                          inv_date)
+                if serial_hash in ledger:
+                    continue
+            normalized = normalize_serial(serial)
+            if normalized and normalized not in credited and (
+                    normalized in serials or serial in serial_index):
+                print("DUPLICATE SERIAL:", serial)
+                if skip_duplicates:
+                    continue
+            serials.add(normalized)
+            e = EquipmentRecord(item_id, serial, True, False, customer_id,
+                                inv_date)
+            work.add(e)
+            count += 1
+            if serial_hash is not None:
+                serial_hashes.append(serial_hash)
+    units, start = export.units(credits=True)
+    for k in in_batches(range(len(export)), tracker, cancel):
+        if ledger is not None and line_hashes[export.line[k]] in ledger:
+            continue
+        customer = export.customer[k]
+        inv_num = export.model[k]
+        inv_date = export.date[k]
+        if inv_num is None or inv_date is None:
+            if start[k] != start[k+1]:
+                unapplied.add(k)
+            continue
+        for serial in units[start[k]:start[k+1]]:
+            serial_hash = None
+            if ledger is not None and serial:
+                serial_hash = ledger.hash('credit', customer, inv_num, serial,
+                                          export.date_text[k])
+                if serial_hash in ledger:
+                    continue
+            e = EquipmentList(InventoryNum=inv_num, SerialNumber=serial,
+                              CustomerNum=customer, order_by='invoice-date')
+            for j in e.get_equipment():
+                if dateutil.parser.parse(j[6]) < inv_date:
+                    print("REMOVING", export.type[k], export.date_text[k],
+                          customer, inv_num, serial)
+                    # The delete and its hash are committed together.
+                    work.delete(j[0])
+                    if serial_hash is not None:
+                        ledger.add(serial_hash)
+                    work.flush()
+                    count += 1
                     break
-                if customer_id is not None and item_id is not None:
-                    e = EquipmentRecord(item_id, serial[i], True, False,
-                                        customer_id, inv_date)
-                    e.add_record()
-    for item in reader:
-        if item[0] == 'Invoice' or item[0] == 'Credit Memo':
-            if int(item[4]) < 0:
-                serial = item[5].split(',')
-                for i in range(-int(item[4])):
-                    try:
-                        serial[i]
-                    except IndexError:
-                        break
-                    else:
-                        inv_num = re.search(r'(.+?)(?= \()', item[3])
-                        inv_num = inv_num.group(0)
-                        e = EquipmentList(InventoryNum=inv_num,
-                                          SerialNumber=serial[i],
-                                          CustomerNum=item[2])
-                        # Reverse sort order so that newer items are first.
-                        e = e.get_equipment()[::-1]
-                        for j in e:
-                            if (dateutil.parser.parse(j[6]) <
-                                    dateutil.parser.parse(item[1])):
-                                print("REMOVING", item)
-                                with stalmic_connection(True) as cursor:
-                                    command = '''
-                                    DELETE FROM EquipmentRecords
-                                    WHERE EquipmentRecordsID = ?'''
-                                    cursor.execute(command, j[0])
-                                break
-
-
-def import_purchases_csv(filename):
-    """ Imports purchase data from a CSV."""
+            else:
+                # Nothing to credit yet; the sale may be in a later export.
+                unapplied.add(k)
+    # Only now is every other line fully applied.
+    if ledger is not None:
+        skipped = {export.line[k] for k in unapplied}
+        for i, line_hash in enumerate(line_hashes):
+            if i not in skipped:
+                ledger.add(line_hash)
+        ledger.save()
+    return count
+
+
+def import_purchases_csv(filename, progress=None, cancel=None):
+    """ Imports purchase data from a CSV. Returns the number of records
+    updated. See the progress module for progress and cancel."""
     with open(filename, newline='', encoding='utf-8-sig') as file:
         reader = list(csv.reader(file))
+    count = 0
+    work = UnitOfWork()
     serials = set()
-    for item in reader:
+    tracker = Progress(progress, len(reader))
+    for item in in_batches(reader, tracker, cancel, work.flush):
         if item[0] == 'Bill' and item[1] != '':
             pur_date = dateutil.parser.parse(item[1])
             serial = item[5].split(',')
             for serial_number in serial:
                 if serial_number == '':
                     break
-                if serial_number in serials:
+                normalized = normalize_serial(serial_number)
+                if (normalized in serials or
+                        len(get_serial_index().find(serial_number)) > 1):
                     print("DUPLICATE SERIAL:", serial_number)
+                serials.add(normalized)
                 e = EquipmentList(SerialNumber=serial_number)
                 e = e.get_equipment()
                 for i in e:
-                    with stalmic_connection(True) as cursor:
-                        command = '''
-                        UPDATE EquipmentRecords
-                        SET PurchaseDate = ?
-                        WHERE EquipmentRecordsID = ?'''
-                        cursor.execute(command, (pur_date, i[0]))
+                    work.update(i[0], PurchaseDate=pur_date)
+                    count += 1
+    return count
 
 
-def import_warranty_csv(filename):
-    """Imports warranty data from a CSV."""
+def import_warranty_csv(filename, progress=None, cancel=None):
+    """Imports warranty data from a CSV. Returns the number of records
+    updated. See the progress module for progress and cancel."""
     with open(filename, newline='', encoding='utf-8-sig') as file:
         reader = list(csv.reader(file))
-    for item in reader:
+    count = 0
+    work = UnitOfWork()
+    tracker = Progress(progress, len(reader))
+    for item in in_batches(reader, tracker, cancel, work.flush):
         if item[0] == 'Invoice' and item[1] != '' and int(item[4]) > 0:
             inv_date = dateutil.parser.parse(item[1])
             today = datetime.datetime.now()
@@ -548,9 +1554,6 @@ def import_warranty_csv(filename):
             e = e.get_equipment()
             for i in e:
                 if dateutil.parser.parse(i[6]) <= inv_date:
-                    with stalmic_connection(True) as cursor:
-                        command = '''
-                        UPDATE EquipmentRecords
-                        SET ServiceAgreement = 1
-                        WHERE EquipmentRecordsID = ?'''
-                        cursor.execute(command, i[0])
+                    work.update(i[0], ServiceAgreement=True)
+                    count += 1
+    return count
@@ -1,13 +1,20 @@
 """ GUI Module for Stalmic Equipment Record Keeper
 """
 
+import sys
+import time
 import tkinter as tk
 from tkinter import ttk
 from tkinter import font
+from tkinter import messagebox
+from tkinter import filedialog
 import dbfunctions as db
+import reports
 import dateutil.parser
-
-TITLE = "Equipment Records"
+from notify import TITLE
+import profiling
+from profiling import profiled
+from progress import CancelToken, Cancelled
 
 
 class AutocompleteCombobox(ttk.Combobox):
@@ -51,6 +58,7 @@ class AutocompleteCombobox(ttk.Combobox):
             self.insert(0, self._hits[self._hit_index])
             self.select_range(self.position, tk.END)
 
+    @profiled()
     def handle_keyrelease(self, event):
         """
         Event handler for the keyrelease event on this widget.
@@ -81,26 +89,47 @@ class ResultsWindow(tk.Frame):
         self.vsb = tk.Scrollbar(self.parent, orient='vertical',
                                 command=self.canvas.yview)
         self.canvas.configure(yscrollcommand=self.vsb.set)
-        width, height = self.parent.grid_size()
-        self.vsb.grid(row=height, column=width+1, sticky=tk.N+tk.S+tk.W)
+        # The scrollbar goes right after the columns the canvas spans.
+        self.vsb.grid(row=row, column=column+columnspan,
+                      sticky=tk.N+tk.S+tk.W)
         self.canvas.grid(row=row, column=column, columnspan=columnspan,
                          sticky=sticky)
         self.canvas.create_window((4, 4), window=self.frame, anchor='nw',
                                   tags='self.frame')
+        # Check boxes for the rows selected for bulk edits.
+        self.selected = {}
+        self.select_all = tk.IntVar()
+        self.ids = []
         self.parent.bind('<Enter>', self._bound_to_mousewheel)
         self.parent.bind('<Leave>', self._unbound_to_mousewheel)
         self.frame.bind('<Configure>', self.on_frame_configure)
+        # The EquipmentRecords behind the rows, by ID.
+        self.records = {}
 
+    @profiled()
+    @profiling.widgets()
     def populate(self, data):
         """ Populates the results window with results in a grid."""
         for widget in self.frame.winfo_children():
             widget.destroy()
+        self.selected = {}
+        self.select_all.set(0)
+        self.ids = [x[0] for x in data[1:]]
         for r in range(min(len(data), 100)):
             if r != 0:
+                self.selected[data[r][0]] = tk.IntVar()
+                checkbox = tk.Checkbutton(self.frame,
+                                          variable=self.selected[data[r][0]])
+                checkbox.grid(row=r, column=0)
                 editbutton = tk.Button(self.frame, text="Edit",
                                        command=lambda x=r: self.edit(
-                                           data[x][0]))
-                editbutton.grid(row=r, column=0)
+                                           data[x]))
+                editbutton.grid(row=r, column=1)
+            else:
+                checkbox = tk.Checkbutton(self.frame,
+                                          variable=self.select_all,
+                                          command=self.toggle_all)
+                checkbox.grid(row=r, column=0)
             for c in range(len(data[r])):
                 item = tk.Label(self.frame, text=str(data[r][c]))
                 if r == 0:
@@ -111,9 +140,22 @@ class ResultsWindow(tk.Frame):
                     item.configure(text='YES', foreground='green')
                 elif data[r][c] is False:
                     item.configure(text='NO', foreground='red')
-                item.grid(row=r, column=c+1, padx=5)
+                item.grid(row=r, column=c+2, padx=5)
             root.update()
 
+    def toggle_all(self):
+        """ Checks or unchecks every row."""
+        for var in self.selected.values():
+            var.set(self.select_all.get())
+
+    def get_selected(self):
+        """ Returns the IDs of the selected rows. Select all also selects the
+        results that weren't shown."""
+        if self.select_all.get():
+            return [x for x in self.ids
+                    if x not in self.selected or self.selected[x].get()]
+        return [x for x in self.selected if self.selected[x].get()]
+
     def on_frame_configure(self, event):
         """ Reset the scroll region to encompass the inner frame"""
         self.canvas.configure(scrollregion=self.canvas.bbox("all"))
@@ -127,9 +169,9 @@ class ResultsWindow(tk.Frame):
     def _on_mousewheel(self, event):
         self.canvas.yview_scroll(int(-1*event.delta//120), 'units')
 
-    def edit(self, id):
-        """ Initialize the edit window."""
-        EditWindow(self, self.main, id)
+    def edit(self, row):
+        """ Initialize the edit window with a row of the results."""
+        EditWindow(self, self.main, row[0], row, self.records.get(row[0]))
 
 
 class MainApplication(tk.Frame):
@@ -137,11 +179,35 @@ class MainApplication(tk.Frame):
     def __init__(self, parent, *args, **kwargs):
         tk.Frame.__init__(self, parent, *args, **kwargs)
         self.parent = parent
+        # Completion lists, by location.
+        self.lists = {}
         # Make a menu bar for the sync command.
         self.menubar = tk.Menu(self.parent)
         self.filemenu = tk.Menu(self.menubar, tearoff=0)
-        self.filemenu.add_command(label='Push to Customer Notes',
-                                  command=db.write_to_notes)
+        self.filemenu.add_command(
+            label='Push to Customer Notes',
+            command=lambda: ProgressWindow(self.parent, self,
+                                           "Push to Customer Notes",
+                                           db.write_to_notes, False,
+                                           "notes"))
+        self.filemenu.add_separator()
+        for label, importer in (("Import Sales...", db.import_sales_csv),
+                                ("Import Purchases...",
+                                 db.import_purchases_csv),
+                                ("Import Warranty...",
+                                 db.import_warranty_csv)):
+            self.filemenu.add_command(
+                label=label,
+                command=lambda x=label, y=importer: self.import_csv(x, y))
+        self.reportmenu = tk.Menu(self.filemenu, tearoff=0)
+        for name in reports.REPORTS:
+            self.reportmenu.add_command(
+                label=reports.REPORTS[name][0],
+                command=lambda x=name: self.save_report(x))
+        self.reportmenu.add_separator()
+        self.reportmenu.add_command(label='Duplicate Serial Numbers',
+                                    command=self.save_duplicates)
+        self.filemenu.add_cascade(label='Reports', menu=self.reportmenu)
         self.menubar.add_cascade(label='Database', menu=self.filemenu)
         self.parent.config(menu=self.menubar)
         # configure row and column weights.
@@ -183,11 +249,19 @@ class MainApplication(tk.Frame):
         self.search_button = tk.Button(self.parent, text="Search",
                                        command=self.search, width=5)
         self.search_button.grid(row=0, column=width)
-        # Big results box. Needs to span past the search button.
+        # Buttons for the rows checked in the results.
+        self.bulk_edit_button = tk.Button(self.parent, text="Edit Sel.",
+                                          command=self.bulk_edit, width=8)
+        self.bulk_edit_button.grid(row=0, column=width+1)
+        self.bulk_delete_button = tk.Button(self.parent, text="Del. Sel.",
+                                            command=self.bulk_delete, width=8)
+        self.bulk_delete_button.grid(row=1, column=width+1)
+        # Big results box. Needs to span past the search and selection
+        # buttons.
         self.results = ResultsWindow(self.parent, self, row=height, column=0,
-                                     columnspan=width+1,
+                                     columnspan=width+2,
                                      sticky=tk.W+tk.E+tk.N+tk.S)
-        self.results.grid(row=height, column=0, columnspan=width+1,
+        self.results.grid(row=height, column=0, columnspan=width+2,
                           sticky=tk.W+tk.E+tk.N+tk.S)
         # self.results = tk.Frame(self.parent)
         # self.results = tk.Text(self.parent, wrap=tk.NONE, font=('Consolas'))
@@ -209,7 +283,20 @@ class MainApplication(tk.Frame):
             tk.Grid.rowconfigure(self.parent, y, weight=1)
 
     def get_lists(self, location):
-        """ Gets lists for the autocomplete comboboxes."""
+        """ Gets lists for the autocomplete comboboxes. They are loaded once
+        and kept until they are changed."""
+        key = tuple(location or ())
+        if key not in self.lists:
+            self.lists[key] = self.load_list(location)
+        return self.lists[key]
+
+    def lists_changed(self):
+        """ Drops the serial number list after records are added or edited.
+        """
+        self.lists.pop(('EquipmentRecords', 'SerialNumber'), None)
+
+    def load_list(self, location):
+        """ Loads a completion list from the database."""
         with db.stalmic_connection() as cursor:
             try:
                 command = '''
@@ -239,6 +326,7 @@ class MainApplication(tk.Frame):
         combo.grid(row=r+1, column=c, sticky=tk.W+tk.E)
         return combo
 
+    @profiled()
     def search(self):
         """ Initiates a search using what is entered in the comboboxes."""
         # Make the search more user friendly. Searches for items that contain
@@ -258,16 +346,17 @@ class MainApplication(tk.Frame):
         if serial:
             serial = serial.split()
             serial = '%' + '%'.join(serial) + '%'
-        pur = self.is_purchase.get()
-        serv = self.is_service.get()
+        # An unchecked box matches any value rather than only False.
+        pur = self.is_purchase.get() or None
+        serv = self.is_service.get() or None
         connection = db.get_stalmic_connection()
-        self.results.populate(columns+
-                              db.EquipmentList(CustomerNum=customer,
-                                               InventoryNum=item,
-                                               SerialNumber=serial,
-                                               StalmicPurchase=pur,
-                                               ServiceAgreement=serv
-                                              ).get_equipment(connection))
+        equipment = db.EquipmentList(CustomerNum=customer,
+                                     InventoryNum=item,
+                                     SerialNumber=serial,
+                                     StalmicPurchase=pur,
+                                     ServiceAgreement=serv)
+        self.results.records = {x.ID: x for x in equipment.equipment}
+        self.results.populate(columns+equipment.get_equipment(connection))
         connection.close()
         # self.results.config(state=tk.NORMAL)
         # self.results.delete(1.0, tk.END)
@@ -279,6 +368,7 @@ class MainApplication(tk.Frame):
         #                                   ServiceAgreement=serv).get_string())
         # self.results.config(state=tk.DISABLED)
 
+    @profiled()
     def add_entry(self):
         """ Adds an entry to the database using information in the comboboxes.
         """
@@ -299,13 +389,66 @@ class MainApplication(tk.Frame):
             purdate = None
         pur = self.is_purchase.get()
         serv = self.is_service.get()
+        duplicates = db.get_serial_index().find(serial)
+        if duplicates and not tk.messagebox.askyesno(
+                TITLE, "Serial number {} is already on {} record(s) (ID {})."
+                " Add it anyway?".format(serial, len(duplicates), ', '.join(
+                    str(x) for x in sorted(duplicates)))):
+            return
         db.EquipmentRecord(item, serial, pur, serv, customer,
                            invdate, vendor, purdate).add_record()
+        self.lists_changed()
         # Clear the fields after adding. Should also probably add a clear
         # button.
         self.search()
         self.clear_fields()
 
+    def bulk_edit(self):
+        """ Opens the bulk edit window for the selected results."""
+        ids = self.results.get_selected()
+        if ids:
+            BulkEditWindow(self.parent, self, ids)
+
+    def bulk_delete(self):
+        """ Deletes the selected results."""
+        ids = self.results.get_selected()
+        if ids and tk.messagebox.askokcancel(
+                TITLE, "Delete {} entries?".format(len(ids))):
+            db.delete_records(ids)
+            self.search()
+
+    def import_csv(self, label, importer):
+        """ Runs an importer on a CSV file chosen by the user."""
+        filename = filedialog.askopenfilename(
+            parent=self.parent, title=label.rstrip('.'),
+            filetypes=[('CSV files', '*.csv')])
+        if filename:
+            ProgressWindow(self.parent, self, label.rstrip('.'),
+                           lambda **kwargs: importer(filename, **kwargs))
+
+    def save_report(self, name):
+        """ Saves a report to a CSV file chosen by the user."""
+        filename = filedialog.asksaveasfilename(
+            parent=self.parent, title=reports.REPORTS[name][0],
+            defaultextension='.csv', initialfile=name + '.csv',
+            filetypes=[('CSV files', '*.csv')])
+        if not filename:
+            return
+        with open(filename, 'w', newline='', encoding='utf-8') as file:
+            reports.write_csv(name, file)
+
+    def save_duplicates(self):
+        """ Saves the duplicate serial number report to a CSV file chosen by
+        the user."""
+        filename = filedialog.asksaveasfilename(
+            parent=self.parent, title="Duplicate Serial Numbers",
+            defaultextension='.csv', initialfile='duplicates.csv',
+            filetypes=[('CSV files', '*.csv')])
+        if not filename:
+            return
+        with open(filename, 'w', newline='', encoding='utf-8') as file:
+            reports.write_duplicates_csv(file)
+
     def clear_fields(self):
         """ Clears the comboboxes."""
         self.model.set('')
@@ -317,14 +460,96 @@ class MainApplication(tk.Frame):
         self.is_service.set(0)
 
 
+class ProgressWindow:
+    """ Runs a long operation with a progress bar and a Cancel button. The
+    operation is called with progress and cancel keyword arguments. If
+    refresh is true the search results are refreshed afterwards."""
+    def __init__(self, parent, main, title, operation, refresh=True,
+                 unit="records"):
+        self.parent = parent
+        self.main = main
+        self.refresh = refresh
+        self.unit = unit
+        self.cancel = CancelToken()
+        self.window = tk.Toplevel(self.parent)
+        self.window.title(title)
+        self.window.grab_set()
+        self.window.protocol('WM_DELETE_WINDOW', self.cancel.cancel)
+        self.bar = ttk.Progressbar(self.window, length=300,
+                                   mode='determinate')
+        self.bar.grid(row=0, column=0, padx=10, pady=5)
+        self.status = tk.Label(self.window, text="Starting...")
+        self.status.grid(row=1, column=0, padx=10)
+        self.button = tk.Button(self.window, text="Cancel",
+                                command=self.stop)
+        self.button.grid(row=2, column=0, pady=5)
+        self.window.update()
+        self.run(operation)
+
+    def stop(self):
+        self.cancel.cancel()
+        self.button.configure(state=tk.DISABLED)
+        self.status.configure(text="Stopping after this batch...")
+
+    @profiled()
+    def run(self, operation):
+        start = time.perf_counter()
+        try:
+            count = operation(progress=self.show_progress, cancel=self.cancel)
+        except Cancelled:
+            self.finish("Cancelled.")
+        except Exception as err:
+            self.finish("Failed: {}".format(err))
+            raise
+        else:
+            self.finish("Done: {} {} in {:.1f}s.".format(
+                count, self.unit, time.perf_counter() - start))
+        if self.refresh:
+            self.main.search()
+
+    def show_progress(self, done, total, rate, eta):
+        """ Progress callback. Also lets Tk handle events, so the Cancel
+        button works while the operation runs."""
+        if total:
+            self.bar.configure(maximum=total, value=done)
+        text = "{} of {} rows, {:.1f} rows/s".format(done, total, rate)
+        if eta is not None:
+            text += ", {:.0f}s left".format(eta)
+        self.status.configure(text=text)
+        self.window.update()
+
+    def finish(self, text):
+        self.status.configure(text=text)
+        self.button.configure(text="Close", state=tk.NORMAL,
+                              command=self.window.destroy)
+        self.window.protocol('WM_DELETE_WINDOW', self.window.destroy)
+
+
 class EditWindow(MainApplication):
     """ Window used for editing, deleting, and saving individual entries."""
-    def __init__(self, parent, main, id, *args, **kwargs):
+    @profiled()
+    def __init__(self, parent, main, id, row=None, record=None, *args,
+                 **kwargs):
         self.parent = parent
         self.main = main
         self.id = id
-        # Get default values
-        self.defaults = db.EquipmentList(ID=self.id).get_equipment()[0]
+        # Open with the row that is already on screen, and only read the
+        # record itself to make sure nobody has changed it since.
+        self.record = db.fetch_record(self.id)
+        if self.record is None:
+            tk.messagebox.showerror(TITLE, "This entry has been deleted.")
+            self.main.search()
+            return
+        if row is not None and record is not None and \
+                self.record.same_as(record):
+            self.defaults = row
+        else:
+            self.defaults = self.record.get_record()
+        self.build()
+
+    @profiling.widgets()
+    def build(self):
+        """ Builds the window, filled in with self.defaults."""
         self.window = tk.Toplevel(self.parent)
         self.window.grab_set()
         self.window.focus()
@@ -375,6 +600,10 @@ class EditWindow(MainApplication):
         for y in range(height):
             tk.Grid.rowconfigure(self.window, y, weight=1)
 
+    def get_lists(self, location):
+        """ Uses the main window's completion lists."""
+        return self.main.get_lists(location)
+
     def add_edit_field(self, label, r, c, default=None):
         """ Adds a field and a label in the edit window at a specified row and
         column, with a default value if there is one."""
@@ -421,27 +650,121 @@ class EditWindow(MainApplication):
             purdate = None
         pur = self.is_purchase.get()
         serv = self.is_service.get()
+        current = db.fetch_record(self.id)
+        if current is None:
+            tk.messagebox.showerror(TITLE, "This entry has been deleted.",
+                                    parent=self.window)
+            return
+        if not current.same_as(self.record) and not tk.messagebox.askokcancel(
+                TITLE, "This entry has been changed since it was opened. "
+                "Overwrite the changes?", parent=self.window):
+            return
         if tk.messagebox.askokcancel(TITLE, "Edit this entry?",
                                      parent=self.window):
             db.EquipmentRecord(item, serial, pur, serv, customer,
                                invdate, vendor, purdate, self.id).edit_record()
+            self.record = db.fetch_record(self.id)
+            self.main.lists_changed()
             self.main.search()
 
     def delete(self):
         """ Deletes an entry from the database via the edit window."""
         if tk.messagebox.askokcancel(TITLE, "Delete this entry?",
                                      parent=self.window):
-            with db.stalmic_connection(True) as cursor:
-                command = '''
-                DELETE FROM EquipmentRecords WHERE EquipmentRecordsID = ?'''
-                cursor.execute(command, self.id)
+            db.delete_records([self.id])
+            self.window.destroy()
+            self.main.search()
+
+
+class BulkEditWindow(EditWindow):
+    """ Window used for changing several entries at once. Only the fields
+    that are filled in are changed."""
+    # Choices for the tri-state check fields.
+    CHOICES = ('', 'Yes', 'No')
+
+    def __init__(self, parent, main, ids, *args, **kwargs):
+        self.parent = parent
+        self.main = main
+        self.ids = ids
+        self.window = tk.Toplevel(self.parent)
+        self.window.title("Edit {} Entries".format(len(self.ids)))
+        self.window.grab_set()
+        self.window.focus()
+        self.value = {}
+
+        self.model = self.add_combobox("Model No.:", 0, 0,
+                                       ['Inventory', 'InventoryNum'])
+        self.customer = self.add_combobox("Customer:", 1, 0,
+                                          ['Customer', 'CustomerNum'])
+        self.invdate = self.add_edit_field("Inv. Date:", 2, 0)
+        self.purdate = self.add_edit_field("Pur. Date:", 3, 0)
+        self.is_purchase = self.add_choice("Stalmic Pur.:", 4, 0)
+        self.is_service = self.add_choice("Service Agr.:", 5, 0)
+
+        self.submitbutton = tk.Button(self.window, text="Submit",
+                                      command=self.submit)
+        self.submitbutton.grid(row=6, column=1)
+        width, height = self.window.grid_size()
+        for x in range(width):
+            tk.Grid.columnconfigure(self.window, x, weight=1)
+        for y in range(height):
+            tk.Grid.rowconfigure(self.window, y, weight=1)
+
+    def add_choice(self, label, r, c):
+        """ Adds a Yes/No field that can also be left blank."""
+        self.value[label] = tk.StringVar()
+        tk.Label(self.window, text=label).grid(row=r, column=c)
+        combo = ttk.Combobox(self.window, textvariable=self.value[label],
+                             values=self.CHOICES, state='readonly')
+        combo.grid(row=r, column=c+1, columnspan=2, sticky=tk.W+tk.E)
+        return combo
+
+    def submit(self):
+        """ Saves the changes to all of the entries."""
+        columns = {}
+        for label, table, column, id_column in (
+                ("Model No.:", 'Inventory', 'InventoryNum', 'InventoryID'),
+                ("Customer:", 'Customer', 'CustomerNum', 'CustomerID')):
+            value = self.value[label].get()
+            if value:
+                columns[id_column] = db.get_id(value, table, column)
+                if columns[id_column] is None:
+                    tk.messagebox.showerror(
+                        TITLE, "{} was not found.".format(value),
+                        parent=self.window)
+                    return
+        for label, column in (("Inv. Date:", 'InvoiceDate'),
+                              ("Pur. Date:", 'PurchaseDate')):
+            value = self.value[label].get()
+            if value:
+                try:
+                    columns[column] = dateutil.parser.parse(value)
+                except ValueError:
+                    tk.messagebox.showerror(
+                        TITLE, "{} is not a date.".format(value),
+                        parent=self.window)
+                    return
+        for label, column in (("Stalmic Pur.:", 'StalmicPurchase'),
+                              ("Service Agr.:", 'ServiceAgreement')):
+            value = self.value[label].get()
+            if value:
+                columns[column] = value == 'Yes'
+        if not columns:
+            return
+        if tk.messagebox.askokcancel(
+                TITLE, "Edit {} entries?".format(len(self.ids)),
+                parent=self.window):
+            db.bulk_update(self.ids, **columns)
             self.window.destroy()
             self.main.search()
 
 
 if __name__ == '__main__':
+    if '--profile' in sys.argv[1:]:
+        profiling.enable()
     root = tk.Tk()
     root.geometry('1024x500')
     root.wm_title(TITLE)
     MainApplication(root)
+    profiling.start_heartbeat(root)
     root.mainloop()
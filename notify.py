@@ -0,0 +1,33 @@
+""" User notification module for Stalmic Equipment Record Keeper."""
+
+import sys
+
+TITLE = "Equipment Records"
+
+# When headless, messages go to the console instead of Tk message boxes so
+# that the database functions can run without a display.
+_headless = False
+
+
+def set_headless(headless=True):
+    """ Sends notifications to stdout/stderr instead of message boxes."""
+    global _headless
+    _headless = headless
+
+
+def show_error(message):
+    """ Shows an error message to the user."""
+    if _headless:
+        sys.stderr.write("ERROR: {}\n".format(message))
+        return
+    from tkinter import messagebox
+    messagebox.showerror(TITLE, message)
+
+
+def show_info(message):
+    """ Shows an informational message to the user."""
+    if _headless:
+        sys.stdout.write("{}\n".format(message))
+        return
+    from tkinter import messagebox
+    messagebox.showinfo(TITLE, message)
@@ -0,0 +1,209 @@
+""" Opt-in latency profiling for Stalmic Equipment Record Keeper.
+
+Start the GUI with --profile to time the GUI handlers, the SQL they run and
+the widgets they build, and to sample how late Tk's event loop runs its
+callbacks. A report is
+written to the working directory when the program exits.
+"""
+
+import atexit
+import contextlib
+import datetime
+import functools
+import time
+
+_enabled = False
+# SQL time, query count and widget time for each handler that is currently
+# running.
+_stack = []
+stats = {}
+# How late each heartbeat ran, in seconds.
+lag = []
+
+
+def is_enabled():
+    return _enabled
+
+
+def enable(report=True):
+    """ Turns profiling on, writing a report at exit if report is true."""
+    global _enabled
+    _enabled = True
+    if report:
+        atexit.register(write_report)
+
+
+class Stats:
+    """ Timings for one handler."""
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.sql = 0.0
+        self.queries = 0
+        self.widgets = 0.0
+
+    def add(self, elapsed, sql, queries, widgets=0.0):
+        self.count += 1
+        self.total += elapsed
+        self.max = max(self.max, elapsed)
+        self.sql += sql
+        self.queries += queries
+        self.widgets += widgets
+
+
+def profiled(name=None):
+    """ Decorator that times a function, and the SQL it runs, when profiling
+    is enabled."""
+    def decorator(function):
+        label = name or function.__qualname__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return function(*args, **kwargs)
+            frame = [0.0, 0, 0.0]
+            _stack.append(frame)
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                _stack.pop()
+                stats.setdefault(label, Stats()).add(elapsed, *frame)
+                # A handler's SQL and widget time also count towards the one
+                # that called it.
+                if _stack:
+                    _stack[-1][0] += frame[0]
+                    _stack[-1][1] += frame[1]
+                    _stack[-1][2] += frame[2]
+        return wrapper
+    return decorator
+
+
+def record_sql(elapsed, query=False):
+    """ Adds database time to the handler that is running."""
+    stats.setdefault('SQL', Stats()).add(elapsed, elapsed, int(query))
+    if _stack:
+        _stack[-1][0] += elapsed
+        _stack[-1][1] += int(query)
+
+
+@contextlib.contextmanager
+def widgets():
+    """ Counts the time spent in a block that builds or updates widgets,
+    less any SQL it runs, as widget time for the handler that is running."""
+    if not _enabled or not _stack:
+        yield
+        return
+    frame = _stack[-1]
+    start = time.perf_counter()
+    sql = frame[0]
+    before = frame[2]
+    try:
+        yield
+    finally:
+        # Set rather than add, so widget time of handlers called from the
+        # block isn't counted twice.
+        frame[2] = before + time.perf_counter() - start - (frame[0] - sql)
+
+
+class ProfilingCursor:
+    """ Wraps a pyodbc cursor to time its executes and fetches."""
+    def __init__(self, cursor):
+        object.__setattr__(self, '_cursor', cursor)
+
+    def _timed(self, name, query, *args):
+        start = time.perf_counter()
+        try:
+            return getattr(self._cursor, name)(*args)
+        finally:
+            record_sql(time.perf_counter() - start, query)
+
+    def execute(self, *args):
+        return self._timed('execute', True, *args)
+
+    def executemany(self, *args):
+        return self._timed('executemany', True, *args)
+
+    def fetchone(self):
+        return self._timed('fetchone', False)
+
+    def fetchmany(self, *args):
+        return self._timed('fetchmany', False, *args)
+
+    def fetchall(self):
+        return self._timed('fetchall', False)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._cursor, name, value)
+
+
+class ProfilingConnection:
+    """ Wraps a pyodbc connection so its cursors are profiled."""
+    def __init__(self, connection):
+        object.__setattr__(self, '_connection', connection)
+
+    def cursor(self):
+        return ProfilingCursor(self._connection.cursor())
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._connection, name, value)
+
+
+def start_heartbeat(widget, interval=100):
+    """ Schedules a callback every interval milliseconds and records how late
+    it runs, which is how long the event loop was blocked."""
+    if not _enabled:
+        return
+    expected = [time.perf_counter() + interval/1000]
+
+    def beat():
+        now = time.perf_counter()
+        lag.append(max(now - expected[0], 0.0))
+        expected[0] = now + interval/1000
+        widget.after(interval, beat)
+    widget.after(interval, beat)
+
+
+def get_report():
+    """ Returns the profiling report as a string."""
+    lines = ["Profile of {}".format(datetime.datetime.now().strftime('%c')),
+             ""]
+    header = ("Handler", "Calls", "Total ms", "Mean ms", "Max ms", "SQL ms",
+              "Queries", "Widget ms", "Other ms")
+    lines.append("{:<40}{:>7}{:>10}{:>10}{:>10}{:>10}{:>9}{:>11}{:>10}".format(
+        *header))
+    for name in sorted(stats, key=lambda x: -stats[x].total):
+        s = stats[name]
+        lines.append(
+            "{:<40}{:>7}{:>10.1f}{:>10.1f}{:>10.1f}{:>10.1f}{:>9}{:>11.1f}"
+            "{:>10.1f}".format(name[:39], s.count, s.total*1000,
+                               s.total/s.count*1000, s.max*1000, s.sql*1000,
+                               s.queries, s.widgets*1000,
+                               (s.total - s.sql - s.widgets)*1000))
+    lines.append("")
+    if lag:
+        samples = sorted(lag)
+        lines.append("Event loop lag over {} heartbeats: mean {:.1f} ms, "
+                     "95th percentile {:.1f} ms, max {:.1f} ms".format(
+                         len(samples), sum(samples)/len(samples)*1000,
+                         samples[int(len(samples)*0.95)]*1000,
+                         samples[-1]*1000))
+    return "\n".join(lines) + "\n"
+
+
+def write_report(filename=None):
+    if not stats and not lag:
+        return
+    if filename is None:
+        filename = datetime.datetime.now().strftime(
+            'profile-%Y%m%d-%H%M%S.txt')
+    with open(filename, 'w') as file:
+        file.write(get_report())
@@ -0,0 +1,90 @@
+""" Progress reporting and cancellation for long-running operations in
+Stalmic Equipment Record Keeper.
+
+Operations take a progress callback, called as
+callback(done, total, rate, eta) with rows per second and the estimated
+seconds left (None until it can be estimated), and a CancelToken that is
+checked between batches.
+"""
+
+import threading
+import time
+
+# Rows per batch. Work is committed, progress reported and cancellation
+# checked at the end of every batch.
+BATCH_SIZE = 100
+
+
+class Cancelled(Exception):
+    """ Raised at a batch boundary when an operation has been cancelled."""
+
+
+class CancelToken:
+    """ Set by the user interface to ask an operation to stop."""
+    def __init__(self):
+        self._event = threading.Event()
+
+    def cancel(self):
+        self._event.set()
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def check(self):
+        """ Raises Cancelled if the operation has been cancelled."""
+        if self.cancelled:
+            raise Cancelled("Cancelled by user.")
+
+
+class Progress:
+    """ Tracks how far along an operation is and passes the rate and ETA to
+    a callback, at most once every interval seconds."""
+    def __init__(self, callback=None, total=None, interval=0.2):
+        self.callback = callback
+        self.total = total
+        self.interval = interval
+        self.done = 0
+        self.start = time.perf_counter()
+        self.last = None
+
+    def update(self, done, force=False):
+        self.done = done
+        if self.callback is None:
+            return
+        now = time.perf_counter()
+        if not force and self.last is not None and \
+                now - self.last < self.interval:
+            return
+        self.last = now
+        elapsed = now - self.start
+        rate = done / elapsed if elapsed > 0 else 0.0
+        eta = None
+        if self.total is not None and rate > 0:
+            eta = max(self.total - done, 0) / rate
+        self.callback(done, self.total, rate, eta)
+
+    def advance(self, count=1):
+        self.update(self.done + count)
+
+
+def in_batches(items, progress=None, cancel=None, flush=None,
+               size=BATCH_SIZE):
+    """ Yields items one at a time. At the end of each batch of size items it
+    calls flush to commit the batch, reports progress and checks cancel, so
+    a cancelled operation stops with every finished batch written."""
+    count = 0
+    for item in items:
+        if count and count % size == 0:
+            if flush is not None:
+                flush()
+            if cancel is not None:
+                cancel.check()
+        yield item
+        count += 1
+        if progress is not None:
+            progress.advance()
+    if flush is not None:
+        flush()
+    if progress is not None:
+        progress.update(progress.done, force=True)
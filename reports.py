@@ -0,0 +1,82 @@
+""" Aggregate reports over EquipmentRecords for Stalmic Equipment Record
+Keeper. The counting is done by the server and results are cached for a few
+minutes."""
+
+import csv
+from resultcache import ResultCache
+
+FROM = '''
+FROM EquipmentRecords
+LEFT JOIN Customer
+ON EquipmentRecords.CustomerID = Customer.CustomerID
+LEFT JOIN Inventory
+ON EquipmentRecords.InventoryID = Inventory.InventoryID
+LEFT JOIN Vendor
+ON EquipmentRecords.VendorID = Vendor.VendorID
+'''
+# Columns shared by every report: units, Stalmic purchases, service
+# agreements and the share of units with each. A NULL flag counts as no.
+COUNTS = '''
+COUNT(*),
+SUM(COALESCE(CAST(StalmicPurchase AS INT), 0)),
+SUM(COALESCE(CAST(ServiceAgreement AS INT), 0)),
+CAST(SUM(COALESCE(CAST(StalmicPurchase AS INT), 0)) AS FLOAT) / COUNT(*),
+CAST(SUM(COALESCE(CAST(ServiceAgreement AS INT), 0)) AS FLOAT) / COUNT(*)
+'''
+COUNT_COLUMNS = ("Units", "Stalmic Pur.", "Service Agr.", "Stalmic Pur. %",
+                 "Service Agr. %")
+
+# Report name: (title, grouping columns, grouping expressions)
+REPORTS = {
+    'customer-model': ("Units per Customer and Model",
+                       ("Customer", "Model No."),
+                       ('CustomerNum', 'InventoryNum')),
+    'customer': ("Coverage by Customer", ("Customer",), ('CustomerNum',)),
+    'model': ("Coverage by Model", ("Model No.",), ('InventoryNum',)),
+    'vendor': ("Coverage by Vendor", ("Vendor",), ('VendorNum',)),
+    'invoice-year': ("Units per Invoice Year", ("Inv. Year",),
+                     ('YEAR(InvoiceDate)',)),
+}
+
+_cache = ResultCache(maxsize=len(REPORTS), ttl=300)
+
+
+def get_report(name):
+    """ Returns the header and rows of a report."""
+    title, columns, groups = REPORTS[name]
+    header = columns + COUNT_COLUMNS
+    rows = _cache.get(name)
+    if rows is None:
+        # Imported here so the report names can be listed without loading
+        # the database configuration.
+        from dbfunctions import stalmic_connection
+        command = 'SELECT {}, {} {} GROUP BY {} ORDER BY {}'.format(
+            ', '.join(groups), COUNTS, FROM, ', '.join(groups),
+            ', '.join(groups))
+        with stalmic_connection() as cursor:
+            cursor.execute(command)
+            rows = [tuple(x) for x in cursor.fetchall()]
+        _cache.put(name, rows)
+    return header, rows
+
+
+def write_csv(name, file):
+    """ Writes a report as CSV to an open file."""
+    header, rows = get_report(name)
+    writer = csv.writer(file)
+    writer.writerow(header)
+    for row in rows:
+        # Write the ratios as percentages.
+        row = list(row)
+        row[-2:] = ['{:.1f}'.format(x*100) for x in row[-2:]]
+        writer.writerow(row)
+
+
+def write_duplicates_csv(file):
+    """ Writes every serial number that is on more than one record as CSV.
+    """
+    from dbfunctions import get_duplicate_serials
+    writer = csv.writer(file)
+    writer.writerow(("Serial No.", "Records", "IDs"))
+    for serial, ids in get_duplicate_serials():
+        writer.writerow((serial, len(ids), ' '.join(str(x) for x in ids)))
@@ -0,0 +1,44 @@
+""" Query result cache for Stalmic Equipment Record Keeper."""
+
+from collections import OrderedDict
+import time
+
+
+class ResultCache:
+    """ A least recently used cache whose entries also expire after ttl
+    seconds, so changes made by other users are eventually picked up."""
+    def __init__(self, maxsize=128, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        """ Returns the cached value for a key, or None if there isn't a fresh
+        one."""
+        try:
+            created, value = self.entries[key]
+        except KeyError:
+            return None
+        if time.monotonic() - created > self.ttl:
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self.entries[key] = (time.monotonic(), value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, predicate):
+        """ Removes every entry for which predicate(key, value) is true."""
+        for key in [x for x in self.entries
+                    if predicate(x, self.entries[x][1])]:
+            del self.entries[key]
+
+    def clear(self):
+        self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
@@ -0,0 +1,167 @@
+""" In-memory n-gram search index for Stalmic Equipment Record Keeper.
+
+SQL Server can't use an index for a LIKE pattern with a leading wildcard, so
+substring searches on serial, model and customer numbers are resolved here to
+EquipmentRecordsIDs and the server only has to do primary key lookups.
+"""
+
+import re
+
+
+def like_to_regex(pattern):
+    """ Compiles a SQL LIKE pattern (% and _ wildcards) into a
+    case-insensitive regular expression to be used with fullmatch."""
+    regex = ''
+    for char in pattern:
+        if char == '%':
+            regex += '.*'
+        elif char == '_':
+            regex += '.'
+        else:
+            regex += re.escape(char)
+    return re.compile(regex, re.IGNORECASE | re.DOTALL)
+
+
+def is_supported(pattern):
+    """ Whether a LIKE pattern can be answered by the index. Bracket
+    character classes are left to the server."""
+    return '[' not in pattern
+
+
+def fold(value):
+    """ Normalizes a value the way the server's collation compares it."""
+    return value.rstrip().lower()
+
+
+class NgramIndex:
+    """ Maps every n-gram of a column's values to the IDs containing it."""
+    def __init__(self, n=3):
+        self.n = n
+        self.postings = {}
+        self.values = {}
+
+    def grams(self, value):
+        return {value[i:i+self.n] for i in range(len(value)-self.n+1)}
+
+    def add(self, id, value):
+        self.remove(id)
+        if value is None:
+            return
+        value = fold(value)
+        self.values[id] = value
+        for gram in self.grams(value):
+            self.postings.setdefault(gram, set()).add(id)
+
+    def remove(self, id):
+        value = self.values.pop(id, None)
+        if value is None:
+            return
+        for gram in self.grams(value):
+            ids = self.postings.get(gram)
+            if ids is not None:
+                ids.discard(id)
+                if not ids:
+                    del self.postings[gram]
+
+    def search(self, pattern):
+        """ Returns the set of IDs whose value matches a LIKE pattern."""
+        grams = set()
+        for segment in re.split('[%_]', fold(pattern)):
+            grams |= self.grams(segment)
+        candidates = None
+        # Intersect the rarest grams first so the candidate set stays small.
+        grams = sorted(grams, key=lambda x: len(self.postings.get(x, ())))
+        for gram in grams:
+            ids = self.postings.get(gram)
+            if not ids:
+                return set()
+            candidates = set(ids) if candidates is None else candidates & ids
+            if not candidates:
+                return set()
+        if candidates is None:
+            # Pattern is too short for any n-grams, check every value.
+            candidates = self.values
+        # The n-grams only narrow it down; the order and wildcards still
+        # have to be checked.
+        regex = like_to_regex(pattern.rstrip())
+        return {x for x in candidates if regex.fullmatch(self.values[x])}
+
+
+class EquipmentSearchIndex:
+    """ N-gram indexes over SerialNumber, InventoryNum and CustomerNum for
+    every equipment record."""
+    COLUMNS = ('SerialNumber', 'InventoryNum', 'CustomerNum')
+
+    def __init__(self, rows=()):
+        self.indexes = {column: NgramIndex() for column in self.COLUMNS}
+        for row in rows:
+            self.update(*row)
+
+    def update(self, id, SerialNumber, InventoryNum, CustomerNum):
+        """ Adds or replaces a record."""
+        self.indexes['SerialNumber'].add(id, SerialNumber)
+        self.indexes['InventoryNum'].add(id, InventoryNum)
+        self.indexes['CustomerNum'].add(id, CustomerNum)
+
+    def remove(self, id):
+        for index in self.indexes.values():
+            index.remove(id)
+
+    def search(self, **patterns):
+        """ Returns the IDs matching all of the given column LIKE patterns, or
+        None if the patterns can't be answered by the index."""
+        patterns = {x: patterns[x] for x in patterns if patterns[x]}
+        if not patterns or not all(is_supported(x)
+                                   for x in patterns.values()):
+            return None
+        ids = None
+        for column, pattern in patterns.items():
+            found = self.indexes[column].search(pattern)
+            ids = found if ids is None else ids & found
+            if not ids:
+                return set()
+        return ids
+
+
+def normalize_serial(serial):
+    """ Trims and case-folds a serial number for duplicate checks."""
+    return serial.strip().casefold() if serial else ''
+
+
+class SerialIndex:
+    """ Maps normalized serial numbers to the IDs of the records that have
+    them, for duplicate checks."""
+    def __init__(self, rows=()):
+        self.ids = {}
+        self.serials = {}
+        for row in rows:
+            self.add(*row)
+
+    def add(self, id, serial):
+        """ Adds or replaces a record."""
+        self.remove(id)
+        serial = normalize_serial(serial)
+        if not serial:
+            return
+        self.serials[id] = serial
+        self.ids.setdefault(serial, set()).add(id)
+
+    def remove(self, id):
+        serial = self.serials.pop(id, None)
+        if serial is None:
+            return
+        self.ids[serial].discard(id)
+        if not self.ids[serial]:
+            del self.ids[serial]
+
+    def find(self, serial):
+        """ Returns the IDs of the records with a serial number."""
+        return set(self.ids.get(normalize_serial(serial), ()))
+
+    def __contains__(self, serial):
+        return normalize_serial(serial) in self.ids
+
+    def get_duplicates(self):
+        """ Returns {serial: IDs} for every serial on more than one record."""
+        return {x: sorted(self.ids[x]) for x in self.ids
+                if len(self.ids[x]) > 1}
@@ -0,0 +1,62 @@
+""" Columnar staging of sales exports for Stalmic Equipment Record Keeper.
+
+An export is loaded once into a list per field. Values that repeat across
+lines, such as dates and item descriptions, are parsed once each, and the
+serial numbers of every line are flattened into a single list of units, so
+the importer works from ready-made columns instead of parsing line by line.
+"""
+
+import itertools
+import re
+import dateutil.parser
+
+# The model number is the part of an item description before " (".
+MODEL = re.compile(r'(.+?)(?= \()')
+SALES_TYPES = ('Invoice', 'Credit Memo')
+
+
+def parse_all(values, parse):
+    """ Applies parse once to each distinct value and returns the results in
+    the order of values."""
+    parsed = {x: parse(x) for x in set(values)}
+    return [parsed[x] for x in values]
+
+
+def parse_date(text):
+    return dateutil.parser.parse(text) if text else None
+
+
+def parse_model(description):
+    match = MODEL.search(description)
+    return match.group(0) if match else None
+
+
+class SalesExport:
+    """ The invoice and credit memo lines of a sales export, as columns.
+    Line k of the export is row line[k] of the file."""
+    def __init__(self, rows):
+        rows = [(i, x) for i, x in enumerate(rows)
+                if x and x[0] in SALES_TYPES]
+        self.line = [i for i, x in rows]
+        self.type = [x[0] for i, x in rows]
+        self.date_text = [x[1] for i, x in rows]
+        self.customer = [x[2] for i, x in rows]
+        self.quantity = [int(x[4]) for i, x in rows]
+        self.serials = [x[5].split(',') for i, x in rows]
+        self.date = parse_all(self.date_text, parse_date)
+        self.model = parse_all([x[3] for i, x in rows], parse_model)
+
+    def __len__(self):
+        return len(self.line)
+
+    def units(self, credits=False):
+        """ Returns the serial numbers of every unit sold, or credited if
+        credits is true, as one list, and the offset of each line's first
+        unit, so line k's units are serials[start[k]:start[k+1]]. A line has
+        as many units as both its quantity and its serial list allow."""
+        sign = -1 if credits else 1
+        taken = [serials[:max(sign * quantity, 0)]
+                 for quantity, serials in zip(self.quantity, self.serials)]
+        start = list(itertools.accumulate(
+            itertools.chain((0,), (len(x) for x in taken))))
+        return list(itertools.chain.from_iterable(taken)), start